@@ -15,6 +15,7 @@
 Classes:
     - BtleSensor
 """
+import time
 from bluepy.btle import Scanner, DefaultDelegate
 from core.sensor import Sensor
 from core.utils import parse_values, get_sequential_params
@@ -64,8 +65,22 @@ class BtleSensor(Sensor):
         """
         self.log.debug("Checking for BTLE devices")
         scanner = Scanner().withDelegate(DefaultDelegate())
-        # Scan for packets and get a list of the addresses found
-        scanneddevs = [dev.addr for dev in scanner.scan(self.timeout)]
+        # Scan for packets in one second slices so a shutdown doesn't have to
+        # wait for the full timeout, then get a list of the addresses found
+        scanner.clear()
+        scanner.start()
+        try:
+            deadline = time.monotonic() + self.timeout
+            remaining = self.timeout
+            while remaining > 0 and not self.stop_event.is_set():
+                scanner.process(min(remaining, 1))
+                remaining = deadline - time.monotonic()
+        finally:
+            scanner.stop()
+        if self.stop_event.is_set():
+            self.log.debug("Scan interrupted, sensor_reporter is stopping")
+            return
+        scanneddevs = [dev.addr for dev in scanner.getDevices()]
         # Get a list of addresses for which one or more packets were found during
         # the scan.
         self.log.debug("Packets is %s", scanneddevs)
@@ -76,7 +76,8 @@ class GoveeSensor(Sensor):
                                                    ".2f")
 
                 self.log.debug("Govee data to publish: %s", self.devices)
-                self.publish_state()
+                with self.aggregating():
+                    self.publish_state()
 
             # Process an rssi reading. Don't bother to publish now, wait for the
             # next sensor reading.
@@ -89,14 +90,13 @@ class GoveeSensor(Sensor):
     def publish_state(self):
         """Publishes the most recent of all the readings."""
 
-        for conn in self.publishers:
-            for mac in self.devices:
-                if "name" in self.devices[mac]:
-                    name = self.devices[mac]["name"]
-                    dest = "{}/{}".format(self.dest_root, name)
-                    for dev in [dev for dev in self.devices[mac] if dev != "name"]:
-                        conn.publish(str(self.devices[mac][dev]),
-                                     "{}/{}".format(dest, dev))
+        for mac in self.devices:
+            if "name" in self.devices[mac]:
+                name = self.devices[mac]["name"]
+                dest = "{}/{}".format(self.dest_root, name)
+                for dev in [dev for dev in self.devices[mac] if dev != "name"]:
+                    self._send(str(self.devices[mac][dev]),
+                               "{}/{}".format(dest, dev))
 
     def cleanup(self):
         """Stop the observer."""
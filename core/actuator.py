@@ -20,6 +20,7 @@ from abc import ABC, abstractmethod
 import logging
 from configparser import NoOptionError
 from core.utils import set_log_level
+from core.event_loop import run_coroutine
 
 class Actuator(ABC):
     """Class from which all actuator capabilities must inherit. Is assumes there
@@ -44,6 +45,7 @@ class Actuator(ABC):
         self.log = logging.getLogger(type(self).__name__)
         self.params = params
         self.connections = connections
+        self.registrations = []
         self.cmd_src = params("CommandSrc")
         try:
             self.destination = params("ResultsDest")
@@ -57,9 +59,20 @@ class Actuator(ABC):
         """Protected method that registers to the communicator to subscribe to
         destination and process incoming messages with handler.
         """
+        self.registrations.append((destination, handler))
         for conn in self.connections:
             conn.register(destination, handler)
 
+    def unregister(self):
+        """Removes all the handlers this actuator registered from the
+        connections. Called when the actuator is removed on a reload while the
+        connections keep running.
+        """
+        for destination, handler in self.registrations:
+            for conn in self.connections:
+                conn.unregister(destination, handler)
+        self.registrations = []
+
     @abstractmethod
     def on_message(self, msg):
         """Abstract method that will get called when a message is received on a
@@ -79,7 +92,7 @@ class Actuator(ABC):
         Parameter filter_echo is intended to activate a filter for looped back messages
         """
         for conn in self.connections:
-            conn.publish(message, destination, filter_echo)
+            run_coroutine(conn.send(message, destination, filter_echo))
 
     def publish_actuator_state(self):
         """Called to publish the current state of the actuator to the publishers.
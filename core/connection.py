@@ -18,11 +18,18 @@ Classes: Connections
 """
 from abc import ABC, abstractmethod
 import logging
+import traceback
+from configparser import NoOptionError
+from distutils.util import strtobool
 from core.utils import set_log_level
+from core.event_loop import run_coroutine
+from core.outbound import OutboundQueue, LatestValues
 
 class Connection(ABC):
     """Parent class that all connections must implement. It provides a default
     implementation for all methods except publish which must be overridden.
+    publish may be implemented as an async def, in which case sensors and
+    actuators schedule it on the PollManager's event loop.
     """
 
     def __init__(self, msg_processor, params):
@@ -32,7 +39,18 @@ class Connection(ABC):
         - msg_processor: Connections will subscribe to a destination for
         communication to the program overall, not an individual actuator or
         sensor. This is the method that gets called when a message is received.
-        - params: set of properties from the loaded ini file.
+        - params: set of properties from the loaded ini file. The optional
+        "QueueSize" enables the outbound queue: send() then returns right away
+        and a sender thread calls publish. "QueuePolicy" is one of
+        "DropOldest" (default), "Coalesce" or "Block" and decides what happens
+        when the queue is full, "QueueBatch" is how many messages the sender
+        takes at once, defaults to 20, and "QueueWindow" how many seconds the
+        sender waits for a full batch, defaults to 0. "BufferOffline", defaults to True, keeps
+        the newest message per destination while the connection is down so it
+        can be published on reconnect, for connections that support it.
+
+        Raises:
+        - ValueError if the queue parameters are invalid.
         """
         self.log = logging.getLogger(type(self).__name__)
         self.msg_processor = msg_processor
@@ -40,6 +58,37 @@ class Connection(ABC):
         self.registered = {}
         set_log_level(params, self.log)
 
+        try:
+            buffer_offline = bool(strtobool(params("BufferOffline")))
+        except NoOptionError:
+            buffer_offline = True
+        self.held = LatestValues() if buffer_offline else None
+
+        self.outbound = None
+        try:
+            size = int(params("QueueSize"))
+        except NoOptionError:
+            size = 0
+        if size > 0:
+            try:
+                policy = params("QueuePolicy")
+            except NoOptionError:
+                policy = "DropOldest"
+            try:
+                batch = int(params("QueueBatch"))
+            except NoOptionError:
+                batch = 20
+            try:
+                window = float(params("QueueWindow"))
+            except NoOptionError:
+                window = 0
+            self.log.info("Publishing through a queue of %d messages with "
+                          "policy %s", size, policy)
+            self.outbound = OutboundQueue(self.publish_batch, size, policy,
+                                          batch,
+                                          "{}-sender".format(type(self).__name__),
+                                          window)
+
     @abstractmethod
     def publish(self, message, destination, filter_echo=False):
         """Abstarct method that must be overriden. When called, send the passed
@@ -48,6 +97,70 @@ class Connection(ABC):
         Parameter filter_echo is intended to activate a filter for looped back messages
         """
 
+    def send(self, message, destination, filter_echo=False):
+        """Called by Sensors and Actuators to publish. Queues the message if
+        the outbound queue is enabled, otherwise calls publish and returns its
+        result.
+        """
+        if self.outbound:
+            self.outbound.put(message, destination, filter_echo)
+            return None
+        return self.publish(message, destination, filter_echo)
+
+    def publish_batch(self, messages):
+        """Called from the outbound queue's sender thread with a list of
+        (message, destination, filter_echo) tuples. The default implementation
+        publishes them one at a time. Override to publish them more
+        efficiently.
+        """
+        for message, destination, filter_echo in messages:
+            try:
+                run_coroutine(self.publish(message, destination, filter_echo))
+            except:
+                self.log.error("Error publishing %s to %s: %s", message,
+                               destination, traceback.format_exc())
+
+    def _hold(self, message, destination, filter_echo=False):
+        """Called by implementations that can't publish right now. Keeps
+        message as the newest one for destination if BufferOffline is enabled.
+        Returns False if the message is dropped.
+        """
+        if self.held is None:
+            return False
+        self.held.put(message, destination, filter_echo)
+        return True
+
+    def _publish_held(self):
+        """Called by implementations when they (re)connect. Publishes the held
+        messages, one per destination.
+        """
+        if self.held is None:
+            return
+        held = self.held.take()
+        if held:
+            self.log.info("Publishing %d held messages", len(held))
+            self.publish_batch(held)
+
+    def flush(self, timeout=None):
+        """Waits up to timeout seconds for the outbound queue to be published
+        and stops its sender. Called before disconnect.
+        """
+        if self.outbound and not self.outbound.close(timeout):
+            self.log.warning("Dropping %d queued messages",
+                             self.outbound.depth())
+
+    def get_metrics(self):
+        """Returns a dict of statistics about this connection, e.g. the
+        outbound queue's depth and drop counts.
+        """
+        metrics = {}
+        if self.outbound:
+            metrics["queue"] = self.outbound.get_metrics()
+        if self.held is not None:
+            metrics["held"] = len(self.held)
+            metrics["held_replaced"] = self.held.replaced
+        return metrics
+
     def disconnect(self):
         """Disconnect from the connection and release any resources."""
 
@@ -57,3 +170,11 @@ class Connection(ABC):
         """
         self.log.info("Registering destination %s", destination)
         self.registered[destination] = handler
+
+    def unregister(self, destination, handler=None):
+        """Stop calling the handler registered for destination. If handler is
+        passed it is only removed if it is the one registered.
+        """
+        self.log.info("Unregistering destination %s", destination)
+        if handler is None or self.registered.get(destination) == handler:
+            self.registered.pop(destination, None)
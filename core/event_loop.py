@@ -0,0 +1,86 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps track of the asyncio event loop the PollManager runs in the Asyncio
+executor mode so synchronous code can hand coroutines to it.
+
+Functions:
+    - set_loop: Records the running event loop, None when it stops.
+    - get_loop: Returns the recorded event loop or None.
+    - run_coroutine: Runs the passed in object if it is a coroutine.
+    - run_sync: Awaitable that runs a blocking function in the executor.
+"""
+import asyncio
+import logging
+
+_log = logging.getLogger("event_loop")
+_loop = None
+_executor = None
+# Strong references to the scheduled tasks so they aren't garbage collected
+# before they finish.
+_tasks = set()
+
+def set_loop(loop, executor=None):
+    """Records the event loop coroutines get scheduled on and the executor
+    blocking functions are run in.
+    """
+    global _loop, _executor
+    _loop = loop
+    _executor = executor
+
+def get_loop():
+    """Returns the recorded event loop, None if there isn't one."""
+    return _loop
+
+def run_coroutine(result):
+    """Lets callers treat synchronous and async implementations the same. If
+    result is a coroutine it is scheduled on the event loop running in the
+    current thread, or on the recorded event loop when called from another
+    thread. When there is no event loop at all the coroutine is run to
+    completion in the calling thread. Anything else is ignored.
+    """
+    if not asyncio.iscoroutine(result):
+        return
+
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+
+    if running:
+        task = running.create_task(result)
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+        task.add_done_callback(_log_exception)
+    elif _loop and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(result, _loop).add_done_callback(
+            _log_exception)
+    else:
+        asyncio.run(result)
+
+def _log_exception(future):
+    """Logs the exception of a scheduled coroutine nobody waits for."""
+    if future.cancelled():
+        return
+    exc = future.exception()
+    if exc:
+        _log.error("Error in scheduled coroutine: %s", exc,
+                   exc_info=(type(exc), exc, exc.__traceback__))
+
+async def run_sync(func, *args):
+    """Runs the blocking func with args in the recorded executor, or the
+    loop's default executor if there is none, and returns its result.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor, func,
+                                                            *args)
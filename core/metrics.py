@@ -0,0 +1,140 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contains the classes the PollManager uses to measure how the sensor checks
+perform.
+
+Classes:
+    - Histogram: counts observations in fixed buckets.
+    - PollMetrics: per sensor durations, scheduling lag, skips and errors.
+    - MetricsReporter: a Sensor that publishes the PollManager's metrics.
+"""
+import json
+from bisect import bisect_left
+from threading import Lock
+from core.sensor import Sensor
+
+# Upper bounds of the buckets in seconds, the last bucket catches the rest.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+class Histogram:
+    """Counts observations in the fixed BUCKETS and keeps the count, sum and
+    maximum of all of them.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Adds value to the histogram."""
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        """Returns the histogram as a dict with the bucket counts keyed by the
+        bucket's upper bound.
+        """
+        buckets = {str(bound): cnt for bound, cnt in zip(BUCKETS, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0,
+            "buckets": buckets
+        }
+
+class PollMetrics:
+    """Thread safe table of the check_state durations, scheduling lag, skipped
+    polls and exceptions for each sensor, keyed by the sensor's section name.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sensors = {}
+
+    def _get(self, key):
+        """Returns the entry for key, creating it if needed. Must be called
+        with the lock held.
+        """
+        entry = self.sensors.get(key)
+        if entry is None:
+            entry = {
+                "polls": 0,
+                "skipped": 0,
+                "errors": 0,
+                "duration": Histogram(),
+                "lag": Histogram()
+            }
+            self.sensors[key] = entry
+        return entry
+
+    def started(self, key, lag):
+        """Records that a check started lag seconds after it was due. lag is
+        None when there was no due time, e.g. the first poll.
+        """
+        with self.lock:
+            entry = self._get(key)
+            entry["polls"] += 1
+            if lag is not None:
+                entry["lag"].observe(max(lag, 0.0))
+
+    def finished(self, key, duration, error=False):
+        """Records how long a check took and whether it raised."""
+        with self.lock:
+            entry = self._get(key)
+            entry["duration"].observe(duration)
+            if error:
+                entry["errors"] += 1
+
+    def skipped(self, key):
+        """Records a poll skipped because the previous one was still running."""
+        with self.lock:
+            self._get(key)["skipped"] += 1
+
+    def skip_counts(self):
+        """Returns a dict of the skipped polls keyed by sensor."""
+        with self.lock:
+            return {key: entry["skipped"] for key, entry in self.sensors.items()
+                    if entry["skipped"]}
+
+    def snapshot(self):
+        """Returns a copy of all the metrics as plain dicts."""
+        with self.lock:
+            return {key: {name: val.to_dict() if isinstance(val, Histogram)
+                          else val for name, val in entry.items()}
+                    for key, entry in self.sensors.items()}
+
+class MetricsReporter(Sensor):
+    """Publishes the PollManager's metrics as a JSON document. It is scheduled
+    by the PollManager like any other polling sensor.
+    """
+
+    def __init__(self, publishers, params, poll_mgr):
+        """Expects the following parameters:
+        - "MetricsDest": destination to publish the metrics to
+        - "MetricsPoll": optional, how often to publish, defaults to 60 seconds
+        """
+        super().__init__(publishers, params)
+        self.poll_mgr = poll_mgr
+        self.destination = params("MetricsDest")
+
+    def publish_state(self):
+        """Publishes the current metrics."""
+        self._send(json.dumps(self.poll_mgr.get_metrics()), self.destination)
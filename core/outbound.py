@@ -0,0 +1,170 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contains the structures Connections use to hold outbound messages.
+
+Classes:
+    - OutboundQueue: bounded queue to publish from a dedicated thread instead
+    of the caller's.
+    - LatestValues: keeps only the newest message per destination.
+"""
+from collections import OrderedDict
+from itertools import count
+from threading import Thread, Condition, Lock
+
+POLICIES = ("DropOldest", "Coalesce", "Block")
+
+class LatestValues:
+    """Holds the newest (message, destination, filter_echo) per destination,
+    e.g. while a connection is down. A new message to a destination replaces
+    the pending one in O(1), so memory is bounded by the number of
+    destinations. Destinations keep the order they were first held in.
+    """
+
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.lock = Lock()
+        self.replaced = 0
+
+    def put(self, message, destination, filter_echo=False):
+        """Holds message as the newest one for destination."""
+        with self.lock:
+            if destination in self.pending:
+                self.replaced += 1
+            self.pending[destination] = (message, destination, filter_echo)
+
+    def take(self):
+        """Returns the held messages, one per destination, and forgets them."""
+        with self.lock:
+            held = list(self.pending.values())
+            self.pending.clear()
+        return held
+
+    def __len__(self):
+        return len(self.pending)
+
+class OutboundQueue:
+    """A bounded queue of (message, destination, filter_echo) tuples drained
+    in batches by a daemon sender thread. What happens when the queue is full
+    depends on the policy:
+    - "DropOldest": the oldest pending message is dropped.
+    - "Coalesce": a message to a destination that already has one pending
+    replaces it in place, otherwise the oldest pending message is dropped.
+    - "Block": the caller waits until there is room.
+    """
+
+    def __init__(self, publish_batch, size, policy="DropOldest", batch=20,
+                 name="sender", window=0):
+        """Starts the sender thread.
+
+        Arguments:
+        - publish_batch: called from the sender thread with a list of up to
+        batch (message, destination, filter_echo) tuples
+        - size: maximum number of pending messages
+        - policy: one of POLICIES
+        - batch: maximum number of messages handed to publish_batch at once
+        - name: name of the sender thread
+        - window: seconds the sender waits for a full batch after the first
+        message arrives, giving Coalesce a chance to merge repeated updates
+        Raises:
+        - ValueError if size or batch is < 1 or policy is not supported.
+        """
+        if size < 1 or batch < 1:
+            raise ValueError("Queue size and batch must be > 0: {}, {}"
+                             .format(size, batch))
+        if policy not in POLICIES:
+            raise ValueError("Unsupported queue policy {}, must be one of {}"
+                             .format(policy, POLICIES))
+        self.publish_batch = publish_batch
+        self.size = size
+        self.policy = policy
+        self.batch = batch
+        self.window = window
+        # Keyed by destination when coalescing, otherwise by a sequence number.
+        self.pending = OrderedDict()
+        self.seq = count()
+        self.cond = Condition()
+        self.closed = False
+        self.stats = {"sent": 0, "dropped": 0, "coalesced": 0, "blocked": 0}
+        self.thread = Thread(target=self._drain, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, message, destination, filter_echo=False):
+        """Queues the message and returns right away unless the policy is
+        "Block" and the queue is full. Messages put after close() are dropped.
+        """
+        item = (message, destination, filter_echo)
+        with self.cond:
+            if self.closed:
+                self.stats["dropped"] += 1
+                return
+            if self.policy == "Coalesce" and destination in self.pending:
+                self.pending[destination] = item
+                self.stats["coalesced"] += 1
+                return
+            if self.policy == "Block" and len(self.pending) >= self.size:
+                self.stats["blocked"] += 1
+                self.cond.wait_for(lambda: len(self.pending) < self.size
+                                   or self.closed)
+                if self.closed:
+                    # The sender may already be gone.
+                    self.stats["dropped"] += 1
+                    return
+            while len(self.pending) >= self.size:
+                self.pending.popitem(last=False)
+                self.stats["dropped"] += 1
+            key = destination if self.policy == "Coalesce" else next(self.seq)
+            self.pending[key] = item
+            self.cond.notify_all()
+
+    def _drain(self):
+        """Hands the pending messages to publish_batch until closed and
+        empty.
+        """
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if self.window:
+                    self.cond.wait_for(lambda: len(self.pending) >= self.batch
+                                       or self.closed, self.window)
+                if not self.pending:
+                    return
+                batch = [self.pending.popitem(last=False)[1]
+                         for _ in range(min(self.batch, len(self.pending)))]
+                # Wake up the callers blocked on a full queue.
+                self.cond.notify_all()
+            self.publish_batch(batch)
+            with self.cond:
+                self.stats["sent"] += len(batch)
+
+    def depth(self):
+        """Returns the number of pending messages."""
+        return len(self.pending)
+
+    def get_metrics(self):
+        """Returns the queue depth and the sent, dropped, coalesced and blocked
+        counts.
+        """
+        with self.cond:
+            return dict(self.stats, depth=len(self.pending))
+
+    def close(self, timeout=None):
+        """Stops accepting messages and waits up to timeout seconds for the
+        pending ones to be published. Returns True if they all were.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
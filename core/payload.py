@@ -0,0 +1,51 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contains the encoders Sensors use to publish all the values of one check
+as a single document.
+
+Functions:
+    - create_encoder: Returns the encoder for a payload mode.
+"""
+import json
+from configparser import NoOptionError
+
+PAYLOAD_MODES = ("Messages", "JSON", "CBOR", "MsgPack")
+
+def create_encoder(params):
+    """Returns a function that encodes a dict into the message to publish for
+    the "PayloadMode" parameter, or None when the values are published as
+    separate messages, the default. CBOR needs the cbor2 package and MsgPack
+    the msgpack package.
+
+    Raises:
+    - ValueError if the mode is not supported.
+    """
+    try:
+        mode = params("PayloadMode")
+    except NoOptionError:
+        return None
+
+    if mode == "Messages":
+        return None
+    if mode == "JSON":
+        return lambda doc: json.dumps(doc, separators=(",", ":"))
+    if mode == "CBOR":
+        import cbor2
+        return cbor2.dumps
+    if mode == "MsgPack":
+        import msgpack
+        return msgpack.packb
+    raise ValueError("Unsupported PayloadMode {}, must be one of {}"
+                     .format(mode, PAYLOAD_MODES))
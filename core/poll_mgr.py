@@ -17,9 +17,20 @@
 Classes: PollManager
 """
 import time
-from threading import Thread
+import heapq
+import asyncio
+from collections import deque
+from itertools import count
+from threading import Thread, Event, RLock
+from configparser import NoOptionError
 import traceback
 import logging
+from core.worker_pool import WorkerPool
+from core.metrics import PollMetrics, MetricsReporter
+from core import event_loop
+
+SCHEDULERS = ("Heap", "Scan")
+EXECUTORS = ("Thread", "Pool", "Asyncio")
 
 class PollManager:
     """Manages spawing Processes to call a sensor's check method each configured
@@ -28,78 +39,501 @@ class PollManager:
     the most recent reading of the sensor is published/republished.
     """
 
-    def __init__(self, connections, sensors, actuators):
-        """Prepares the manager to start the polling loop. """
+    def __init__(self, connections, sensors, actuators, params=None):
+        """Prepares the manager to start the polling loop.
+
+        Arguments:
+        - connections: dict of the Connections keyed by name
+        - sensors: dict of the Sensors keyed by section name
+        - actuators: dict of the Actuators keyed by section name
+        - params: optional lambda that returns the value for the passed in key
+        from the PollManager section of the .ini file
+            "Scheduler": optional, "Heap" (default) keeps the sensors in a
+            min-heap ordered by their next deadline and sleeps until the next
+            one is due, "Scan" checks all the sensors every half second.
+            "Executor": optional, "Thread" (default) runs each sensor check in
+            a new thread, "Pool" runs them on a fixed number of worker threads,
+            "Asyncio" runs them on an asyncio event loop, awaiting async
+            check_state implementations and running synchronous ones on the
+            worker threads.
+            "Workers": optional, number of threads used by the "Pool" and
+            "Asyncio" executors, defaults to 4.
+            "MetricsDest": optional, when set the metrics returned by
+            get_metrics are published as JSON to this destination.
+            "MetricsPoll": optional, how often in seconds the metrics are
+            published, defaults to 60.
+            "MetricsConnection": optional, comma separated names of the
+            connections to publish the metrics to, defaults to all of them.
+            "ShutdownTimeout": optional, seconds stop() waits for running
+            sensor checks before abandoning them, defaults to 10.
+        Raises:
+        - ValueError if "Scheduler" or "Executor" is not one of the supported
+        values, "Workers" is < 1, or the "Scan" scheduler is combined with the
+        "Asyncio" executor.
+        """
         self.log = logging.getLogger(type(self).__name__)
         self.connections = connections
         self.sensors = sensors
         self.actuators = actuators
+        self.params = params
         self.stop_poll = False
         self.threads = {}
+        # Set by stop() and add() to interrupt the wait for the next deadline.
+        self._wakeup = Event()
+        # Keys of the sensors added while running that need to be scheduled.
+        self._added = deque()
+        self._seq = count()
+        # The sensors whose check is queued or running, mapped to their section
+        # name. Keyed by the instance so a replacement with the same name is
+        # never skipped because of the check of the sensor it replaced.
+        self.in_flight = {}
+        self.metrics = PollMetrics()
+        # Reentrant because stop() is called from a signal handler that may
+        # interrupt the polling loop while it holds the lock.
+        self.lock = RLock()
+
+        self.scheduler = "Heap"
+        self.executor = "Thread"
+        workers = 4
+        self.shutdown_timeout = 10.0
+        if params:
+            try:
+                self.scheduler = params("Scheduler")
+            except NoOptionError:
+                pass
+            try:
+                self.executor = params("Executor")
+            except NoOptionError:
+                pass
+            try:
+                workers = int(params("Workers"))
+            except NoOptionError:
+                pass
+            try:
+                self.shutdown_timeout = float(params("ShutdownTimeout"))
+            except NoOptionError:
+                pass
+        if self.scheduler not in SCHEDULERS:
+            raise ValueError("Unsupported Scheduler {}, must be one of {}"
+                             .format(self.scheduler, SCHEDULERS))
+        if self.executor not in EXECUTORS:
+            raise ValueError("Unsupported Executor {}, must be one of {}"
+                             .format(self.executor, EXECUTORS))
+        if self.executor == "Asyncio" and self.scheduler != "Heap":
+            raise ValueError("The Asyncio executor requires the Heap scheduler")
+
+        self.pool = None
+        if self.executor in ("Pool", "Asyncio"):
+            self.log.info("Running synchronous sensor checks on %d worker "
+                          "threads", workers)
+            self.pool = WorkerPool(workers, "poll")
+
+        # Only used by the Asyncio executor.
+        self.loop = None
+        self.loop_thread = None
+        self._async_wakeup = None
+        self._tasks = set()
+
+        if params:
+            self._create_metrics_reporter(params)
+
+    def _create_metrics_reporter(self, params):
+        """Adds a MetricsReporter to the polled sensors if "MetricsDest" is
+        configured.
+        """
+        try:
+            params("MetricsDest")
+        except NoOptionError:
+            return
+
+        try:
+            names = params("MetricsConnection").split(",")
+            publishers = [self.connections[name] for name in names]
+        except NoOptionError:
+            publishers = list(self.connections.values())
+        except KeyError as ex:
+            self.log.error("Unknown MetricsConnection %s, not publishing the "
+                           "metrics", ex)
+            return
+
+        def metrics_params(key):
+            if key == "Poll":
+                try:
+                    return params("MetricsPoll")
+                except NoOptionError:
+                    return "60"
+            return params(key)
+
+        reporter = MetricsReporter(publishers, metrics_params, self)
+        self.sensors = dict(self.sensors, PollManager=reporter)
+        self._added.append("PollManager")
 
     def start(self):
         """Kicks off the polling loop. This method will not return until stop()
         is called from a separate thread.
         """
-        self.log.info("Starting polling loop")
+        self.log.info("Starting polling loop using the %s scheduler and the "
+                      "%s executor", self.scheduler, self.executor)
+
+        if self.executor == "Asyncio":
+            # The event loop gets its own thread so the signal handlers, which
+            # run in this thread, can still stop and recreate the PollManager.
+            self.loop_thread = Thread(target=asyncio.run,
+                                      args=(self._async_loop(),),
+                                      name="poll-loop", daemon=True)
+            self.loop_thread.start()
+            while not self.stop_poll:
+                self._wakeup.wait()
+                self._wakeup.clear()
+        elif self.scheduler == "Scan":
+            self._scan_loop()
+        else:
+            self._heap_loop()
 
+    def _scan_loop(self):
+        """Checks every sensor each half second and polls the ones whose
+        polling period has passed.
+        """
         while not self.stop_poll:
+            # Added sensors are picked up from self.sensors directly.
+            self._added.clear()
             for key, sen in {key:sen for (key, sen) in self.sensors.items()
                              if sen.poll > 0
                              and (not sen.last_poll or
                                   (time.time() - sen.last_poll) > sen.poll)}.items():
-                if key in self.threads and self.threads[key].is_alive():
-                    self.log.warning("Sensor %s is still running! Skipping poll.",
-                                     key)
-                else:
-                    # Wrap the call so we can catch and report exceptions.
-                    def runner(target, key):
-                        try:
-                            target()
-                        # TODO create a special exception to catch
-                        except:
-                            self.log.error("Error in checking sensor %s: %s", key,
-                                           traceback.format_exc())
-
-                    sen.last_poll = time.time()
-                    thread = Thread(target=runner,
-                                    args=(sen.check_state, key))
-                    self.threads[key] = thread
-                    thread.start()
-            # TODO measure the time for the fill loop and warn if it continues
-            # to grow.
-            time.sleep(0.5)
+                # Translate the wall clock due time to the monotonic clock
+                # used to measure the scheduling lag.
+                due = None
+                if sen.last_poll:
+                    due = (time.monotonic() - time.time()
+                           + sen.last_poll + sen.poll)
+                self._dispatch(key, sen, due)
+            self._wakeup.wait(0.5)
+            self._wakeup.clear()
+
+    def _heap_loop(self):
+        """Keeps the polling sensors in a min-heap ordered by the monotonic
+        time they are next due and sleeps until the earliest one is due. Only
+        the due sensors are touched on each pass.
+        """
+        heap = self._build_heap()
+        while not self.stop_poll:
+            timeout = self._poll_due(heap)
+            if timeout is None or timeout > 0:
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+
+    async def _async_loop(self):
+        """The Heap scheduler running as a coroutine on the event loop."""
+        self._async_wakeup = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        # Synchronous work handed to event_loop.run_sync runs on the daemon
+        # workers too, so it can't hold up a shutdown.
+        event_loop.set_loop(self.loop, self.pool)
+        try:
+            heap = self._build_heap()
+            while not self.stop_poll:
+                timeout = self._poll_due(heap)
+                if timeout is None or timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._async_wakeup.wait(),
+                                               timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._async_wakeup.clear()
+            if self._tasks:
+                await asyncio.wait(self._tasks, timeout=self.shutdown_timeout)
+        finally:
+            event_loop.set_loop(None)
+
+    def _build_heap(self):
+        """Returns a heap with all the polling sensors due now."""
+        self._added.clear()
+        now = time.monotonic()
+        # The sequence number breaks ties so sensors are never compared to
+        # each other.
+        heap = [(now, next(self._seq), key, sen)
+                for key, sen in self.sensors.items() if sen.poll > 0]
+        heapq.heapify(heap)
+        return heap
+
+    def _poll_due(self, heap):
+        """Schedules the sensors added since the last pass, dispatches the
+        sensors that are due and pushes them back onto the heap with their next
+        deadline. Entries for sensors that were removed or replaced are
+        dropped. Returns the number of seconds until the next sensor is due,
+        None if there are no polling sensors.
+        """
+        now = time.monotonic()
+        if self._added:
+            # A sensor can be added more than once before the loop gets to it,
+            # don't give it a second entry.
+            scheduled = {id(entry[3]) for entry in heap}
+            while self._added:
+                key = self._added.popleft()
+                sen = self.sensors.get(key)
+                if sen and sen.poll > 0 and id(sen) not in scheduled:
+                    scheduled.add(id(sen))
+                    heapq.heappush(heap, (now, next(self._seq), key, sen))
+
+        while heap and heap[0][0] <= now:
+            due, seq, key, sen = heapq.heappop(heap)
+            if self.sensors.get(key) is not sen:
+                continue
+            self._dispatch(key, sen, due)
+            # Keep a fixed rate, but don't try to catch up on missed polls if
+            # the sensor fell behind.
+            due += sen.poll
+            if due <= now:
+                due = now + sen.poll
+            heapq.heappush(heap, (due, seq, key, sen))
+
+        return heap[0][0] - time.monotonic() if heap else None
+
+    def _dispatch(self, key, sen, due=None):
+        """Hands the sensor's check_state to the executor unless the previous
+        check is still queued or running. due is the monotonic time the poll
+        was due, used to measure the scheduling lag.
+        """
+        with self.lock:
+            skip = sen in self.in_flight
+            if not skip:
+                self.in_flight[sen] = key
+        if skip:
+            self.metrics.skipped(key)
+            self.log.warning("Sensor %s is still running! Skipping poll.", key)
+            return
+
+        sen.last_poll = time.time()
+        if self.executor == "Asyncio":
+            task = self.loop.create_task(self._run_async(sen, key, due))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif self.pool:
+            self.pool.submit(self._run, sen, key, due)
+        else:
+            thread = Thread(target=self._run, args=(sen, key, due),
+                            daemon=True)
+            self.threads[key] = thread
+            thread.start()
+
+    def _run(self, sen, key, due=None):
+        """Wraps the sensor's check_state so we can catch and report
+        exceptions. An async check_state is run to completion in the calling
+        thread.
+        """
+        start = time.monotonic()
+        self.metrics.started(key, start - due if due else None)
+        error = False
+        try:
+            with sen.aggregating():
+                event_loop.run_coroutine(sen.check_state())
+        # TODO create a special exception to catch
+        except:
+            error = True
+            self.log.error("Error in checking sensor %s: %s", key,
+                           traceback.format_exc())
+        finally:
+            self.metrics.finished(key, time.monotonic() - start, error)
+            with self.lock:
+                self.in_flight.pop(sen, None)
+
+    async def _run_async(self, sen, key, due=None):
+        """Awaits an async check_state or runs a synchronous one on the worker
+        pool so it doesn't block the event loop. Exceptions and metrics are
+        handled the same way as _run.
+        """
+        start = time.monotonic()
+        self.metrics.started(key, start - due if due else None)
+        error = False
+        try:
+            if asyncio.iscoroutinefunction(sen.check_state):
+                with sen.aggregating():
+                    await sen.check_state()
+            else:
+                await self.loop.run_in_executor(self.pool, self._check, sen)
+        except asyncio.CancelledError:
+            self.log.debug("Check of sensor %s cancelled", key)
+        except:
+            error = True
+            self.log.error("Error in checking sensor %s: %s", key,
+                           traceback.format_exc())
+        finally:
+            self.metrics.finished(key, time.monotonic() - start, error)
+            with self.lock:
+                self.in_flight.pop(sen, None)
+
+    @staticmethod
+    def _check(sen):
+        """Runs a synchronous check_state on a worker thread, which doesn't
+        inherit the event loop's context.
+        """
+        with sen.aggregating():
+            sen.check_state()
+
+    def executor_stats(self):
+        """Returns a dict describing the load on the executor: the number of
+        sensor checks in flight, the number waiting for a free worker, the
+        number of busy workers and the skipped polls per sensor.
+        """
+        skipped = self.metrics.skip_counts()
+        with self.lock:
+            stats = {
+                "executor": self.executor,
+                "in_flight": len(self.in_flight),
+                "skipped": skipped,
+                "skipped_total": sum(skipped.values())
+            }
+        if self.pool:
+            stats["workers"] = len(self.pool.threads)
+            stats["busy"] = self.pool.busy
+            stats["queued"] = self.pool.queue_depth()
+        return stats
+
+    def get_metrics(self):
+        """Returns a dict with the executor_stats, per sensor section name the
+        number of polls, skipped polls and exceptions as well as histograms in
+        seconds of the check_state duration and the scheduling lag (actual
+        start minus due time), and the metrics of each connection.
+        """
+        return {
+            "executor": self.executor_stats(),
+            "sensors": self.metrics.snapshot(),
+            "connections": {name: conn.get_metrics() for name, conn
+                            in self.connections.items()}
+        }
+
+    def _wake(self):
+        """Interrupts the polling loop's wait for the next deadline."""
+        self._wakeup.set()
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._async_wakeup.set)
+
+    def retire(self, sensors=(), actuators=(), connections=()):
+        """Removes the sensors and actuators with the passed in section names
+        and the connections with the passed in names while the polling loop
+        keeps running, then cleans them up. The stop_event of the removed
+        sensors is set and their running checks are waited on for up to the
+        shutdown timeout. Called from the reload thread, never from the
+        polling loop's thread, so the other sensors keep being polled while it
+        waits. Actuators are
+        unregistered from their connections before they are cleaned up. The
+        metrics reporter is retired too when connections are removed, add()
+        recreates it.
+        """
+        sensors = set(sensors)
+        if connections:
+            sensors.add("PollManager")
+        # Rebind rather than modify the dicts so the polling loop never sees
+        # them change while iterating.
+        removed_sensors = [sen for key, sen in self.sensors.items()
+                           if key in sensors]
+        self.sensors = {key: sen for key, sen in self.sensors.items()
+                        if key not in sensors}
+        removed_actuators = [act for key, act in self.actuators.items()
+                             if key in actuators]
+        self.actuators = {key: act for key, act in self.actuators.items()
+                          if key not in actuators}
+        removed_connections = [conn for name, conn in self.connections.items()
+                               if name in connections]
+        self.connections = {name: conn for name, conn
+                            in self.connections.items()
+                            if name not in connections}
+
+        for sen in removed_sensors:
+            sen.stop_event.set()
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        with self.lock:
+            running = [self.in_flight[sen] for sen in removed_sensors
+                       if sen in self.in_flight]
+        while running and time.monotonic() < deadline:
+            time.sleep(0.05)
+            with self.lock:
+                running = [self.in_flight[sen] for sen in removed_sensors
+                           if sen in self.in_flight]
+        if running:
+            self.log.error("Abandoning sensors still running after %s seconds:"
+                           " %s", self.shutdown_timeout,
+                           ", ".join(sorted(running)))
+
+        for sen in removed_sensors:
+            sen.cleanup()
+        for act in removed_actuators:
+            act.unregister()
+            act.cleanup()
+        for conn in removed_connections:
+            conn.flush(self.shutdown_timeout)
+            conn.disconnect()
+
+    def add(self, connections=None, sensors=None, actuators=None):
+        """Adds the passed in dicts of connections, sensors and actuators while
+        the polling loop keeps running. New sensors are polled right away. The
+        metrics reporter is recreated if retire() removed it.
+        """
+        connections = connections or {}
+        sensors = sensors or {}
+        self.connections = dict(self.connections, **connections)
+        self.actuators = dict(self.actuators, **(actuators or {}))
+        self.sensors = dict(self.sensors, **sensors)
+        self._added.extend(sensors)
+        if self.params and "PollManager" not in self.sensors:
+            self._create_metrics_reporter(self.params)
+        self._wake()
 
     def stop(self):
-        """Sets a flag to stop the polling loop. Cancels any outstanding
-        processes and waits for them to fail, then cleans and disconnects all
-        the sensors, actuators, and connections.
+        """Sets a flag to stop the polling loop and sets the stop_event of
+        every sensor to interrupt their waits. Waits up to the shutdown
+        timeout for the running sensor checks, abandoning the stragglers, then
+        cleans and disconnects all the sensors, actuators, and connections.
         """
         # Stop the polling loop
-        # TODO add an Event object that we can use to interrupt sleeps in sensors
         self.stop_poll = True
-        time.sleep(0.5)
+        for sen in self.sensors.values():
+            sen.stop_event.set()
+        self._wake()
 
-        self.log.info("Waiting for all the polling threads")
+        self.log.info("Waiting up to %s seconds for all the polling threads",
+                      self.shutdown_timeout)
+        deadline = time.monotonic() + self.shutdown_timeout
+        remaining = lambda: max(deadline - time.monotonic(), 0)
+        if self.loop_thread:
+            self.loop_thread.join(remaining())
         for thread in self.threads.values():
-            thread.join()
+            thread.join(remaining())
+        if self.pool:
+            self.pool.shutdown(timeout=remaining())
+
+        with self.lock:
+            stragglers = sorted(self.in_flight.values())
+        if stragglers:
+            # The polling threads are daemons so they won't keep the process
+            # from exiting.
+            self.log.error("Abandoning sensors still running after %s seconds:"
+                           " %s", self.shutdown_timeout, ", ".join(stragglers))
 
         self.log.info("Cleaning up the sensors")
         for sen in self.sensors.values():
             sen.cleanup()
 
         self.log.info("Cleaning up the actuators")
-        for act in self.actuators:
+        for act in self.actuators.values():
             act.cleanup()
 
         self.log.info("Disconnecting from connections")
         for conn in self.connections.values():
+            conn.flush(max(remaining(), 1))
             conn.disconnect()
 
     def report(self):
-        """Calls publish_state on all the sensors and actuators."""
+        """Calls publish_state on all the sensors and actuators. The sensors'
+        publish filters are reset first so every current value goes out.
+        """
         for sen in self.sensors.values():
-            sen.publish_state()
+            if sen.publish_filter:
+                sen.publish_filter.reset()
+            with sen.aggregating():
+                sen.publish_state()
 
-        for act in self.actuators:
+        for act in self.actuators.values():
             act.publish_actuator_state()
@@ -0,0 +1,102 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contains the filter Sensors use to drop publishes that don't carry new
+information.
+
+Classes: PublishFilter
+
+Functions:
+    - create_publish_filter: Returns a PublishFilter if one is configured.
+"""
+import time
+from threading import Lock
+from configparser import NoOptionError
+from distutils.util import strtobool
+
+def create_publish_filter(params):
+    """Returns a PublishFilter configured from params, or None when none of
+    its parameters are present so unfiltered sensors pay nothing for it.
+    """
+    def get(key, conv):
+        try:
+            return conv(params(key))
+        except NoOptionError:
+            return None
+
+    deadband = get("Deadband", float)
+    deadband_pct = get("DeadbandPercent", float)
+    repeats = get("SuppressRepeats", lambda v: bool(strtobool(v)))
+    silence = get("MaxSilence", float)
+    if deadband is None and deadband_pct is None and not repeats and not silence:
+        return None
+    return PublishFilter(deadband or 0.0, deadband_pct or 0.0, bool(repeats),
+                         silence or 0.0)
+
+class PublishFilter:
+    """Decides per destination whether a message is worth publishing. Numeric
+    messages within the deadband of the last published value and, optionally,
+    identical repeats are dropped. If MaxSilence seconds passed since the last
+    publish to a destination the next message is always published.
+    """
+
+    def __init__(self, deadband, deadband_pct, suppress_repeats, max_silence):
+        """Arguments:
+        - deadband: absolute change required to publish a numeric message
+        - deadband_pct: change relative to the last published value, in
+        percent, required to publish a numeric message; the larger of the two
+        deadbands applies
+        - suppress_repeats: drop messages equal to the last published one
+        - max_silence: seconds after which a message is published regardless,
+        0 disables it
+        """
+        self.deadband = deadband
+        self.deadband_pct = deadband_pct
+        self.suppress_repeats = suppress_repeats
+        self.max_silence = max_silence
+        self.lock = Lock()
+        # destination -> (message, numeric value or None, monotonic time)
+        self.last = {}
+
+    def allow(self, msg, dest):
+        """Returns True if msg should be published to dest and, if so, records
+        it as the last published value.
+        """
+        now = time.monotonic()
+        try:
+            value = float(msg)
+        except (TypeError, ValueError):
+            value = None
+
+        with self.lock:
+            last = self.last.get(dest)
+            if last and not (self.max_silence
+                             and now - last[2] >= self.max_silence):
+                last_msg, last_value, _ = last
+                if value is not None and last_value is not None:
+                    band = max(self.deadband,
+                               abs(last_value) * self.deadband_pct / 100)
+                    if band and abs(value - last_value) < band:
+                        return False
+                if self.suppress_repeats and msg == last_msg:
+                    return False
+            self.last[dest] = (msg, value, now)
+            return True
+
+    def reset(self):
+        """Forgets the last published values so the next message to every
+        destination is published.
+        """
+        with self.lock:
+            self.last.clear()
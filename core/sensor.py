@@ -18,25 +18,46 @@ Classes: Sensor
 """
 
 from abc import ABC
+import asyncio
 import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Event
 from configparser import NoOptionError
 from core.utils import set_log_level
+from core.event_loop import run_coroutine, run_sync
+from core.payload import create_encoder
+from core.publish_filter import create_publish_filter
+
+# The sensor currently aggregating in this thread or task and the values it
+# collected so far.
+_aggregate = ContextVar("aggregate", default=None)
 
 class Sensor(ABC):
     """Abstract class from which all sensors should inherit. check_state and/or
-    publish_state should be overridden.
+    publish_state should be overridden. check_state may be implemented as an
+    async def, in which case it is awaited on the event loop when the
+    PollManager uses the Asyncio executor.
     """
 
     def __init__(self, publishers, params):
         """
         Sets all the passed in arguments as data members. If params("Poll")
         exists self.poll will be set to that. If not it is initialized to -1.
-        self.last_poll is initialied to None.
+        self.last_poll is initialied to None. self.stop_event is set by the
+        PollManager when sensor_reporter is shutting down or a reload removes
+        this sensor.
 
         Arguments:
         - publishers: list of Connection objects to report to.
         - params: parameters from the section in the .ini file the sensor is created
-        from.
+        from. The optional "Deadband", "DeadbandPercent", "SuppressRepeats"
+        and "MaxSilence" parameters configure self.publish_filter, which drops
+        messages that don't carry new information before they reach the
+        publishers. The optional "PayloadMode" parameter ("JSON", "CBOR" or
+        "MsgPack") combines the values sent while aggregating into one
+        document published to "PayloadDest".
         """
         self.log = logging.getLogger(type(self).__name__)
         self.publishers = publishers
@@ -46,6 +67,10 @@ class Sensor(ABC):
         except NoOptionError:
             self.poll = -1
         self.last_poll = None
+        self.stop_event = Event()
+        self.publish_filter = create_publish_filter(params)
+        self.encode = create_encoder(params)
+        self.payload_dest = params("PayloadDest") if self.encode else None
         set_log_level(params, self.log)
 
 
@@ -60,10 +85,100 @@ class Sensor(ABC):
         implementation is a pass.
         """
 
+    def _wait(self, seconds):
+        """Sleeps for seconds or until sensor_reporter is stopping, whichever
+        comes first. Returns True if it is stopping. Sensors should use this
+        instead of time.sleep so they don't hold up a shutdown.
+        """
+        return self.stop_event.wait(seconds)
+
+    @contextmanager
+    def aggregating(self):
+        """While in this context the values passed to _send and _send_async
+        are collected instead of published and, when a PayloadMode is
+        configured, published as one document at the end. The PollManager
+        wraps check_state and publish_state in it, sensors that publish from
+        their own callbacks should too. Does nothing without a PayloadMode.
+        """
+        current = _aggregate.get()
+        if not self.encode or (current and current[0] is self):
+            yield
+            return
+
+        values = {}
+        token = _aggregate.set((self, values))
+        try:
+            yield
+        finally:
+            _aggregate.reset(token)
+            if values:
+                self._publish_document(values)
+
+    def _collect(self, msg, dest):
+        """Returns True if msg was added to the values being aggregated. In
+        PayloadMode a lone value outside of aggregating() becomes a document
+        of its own.
+        """
+        if not self.encode:
+            return False
+        current = _aggregate.get()
+        if current and current[0] is self:
+            current[1][dest] = msg
+        else:
+            self._publish_document({dest: msg})
+        return True
+
+    def _publish_document(self, values):
+        """Encodes values with a timestamp and publishes them to PayloadDest."""
+        msg = self.encode({"timestamp": round(time.time(), 3),
+                           "values": values})
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._publish(msg, self.payload_dest)
+        else:
+            # Don't block the event loop on synchronous publishers.
+            run_coroutine(self._publish_async(msg, self.payload_dest))
+
     def _send(self, msg, dest):
+        """Sends msg to the dest on all publishers unless the publish filter
+        drops it. Async publishers are scheduled on the event loop without
+        waiting for them.
+        """
+        if self.publish_filter and not self.publish_filter.allow(msg, dest):
+            self.log.debug("Filtered %s to %s", msg, dest)
+            return
+        if not self._collect(msg, dest):
+            self._publish(msg, dest)
+
+    def _publish(self, msg, dest):
         """Sends msg to the dest on all publishers."""
         for conn in self.publishers:
-            conn.publish(msg, dest)
+            run_coroutine(conn.send(msg, dest))
+
+    async def _send_async(self, msg, dest):
+        """Sends msg to the dest on all publishers from an async check_state.
+        Async publishers are awaited, synchronous ones are handed to send() on
+        the worker threads so they don't block the event loop.
+        """
+        if self.publish_filter and not self.publish_filter.allow(msg, dest):
+            self.log.debug("Filtered %s to %s", msg, dest)
+            return
+        if not self._collect(msg, dest):
+            await self._publish_async(msg, dest)
+
+    async def _publish_async(self, msg, dest):
+        """Sends msg to the dest on all publishers from the event loop. Goes
+        through send() like the synchronous path so the outbound queue applies.
+        """
+        for conn in self.publishers:
+            if asyncio.iscoroutinefunction(conn.publish) and not conn.outbound:
+                # send() returns the publish coroutine, await it here.
+                await conn.send(msg, dest)
+            else:
+                # Queuing may block with the Block policy, keep it off the
+                # event loop.
+                await run_sync(conn.send, msg, dest)
 
     def cleanup(self):
         """Called when shutting down the sensor, give it a chance to clean up
@@ -0,0 +1,208 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contains a persistent store-and-forward spool for messages a Connection
+could not publish.
+
+Classes: MessageSpool
+"""
+import logging
+import os
+import sqlite3
+import traceback
+from threading import Thread, Lock, Event
+
+REPLAY_MODES = ("Ordered", "Latest")
+
+class MessageSpool:
+    """Keeps unsent messages in an SQLite database in WAL mode so they survive
+    a restart, and replays them at a limited rate once the connection is back.
+    The number of spooled messages is capped, the oldest are dropped first.
+    """
+
+    def __init__(self, path, max_messages=10000, replay="Ordered", rate=10.0):
+        """Opens or creates the spool database.
+
+        Arguments:
+        - path: the database file, its directory is created if needed
+        - max_messages: maximum number of messages kept
+        - replay: "Ordered" replays every message in the order spooled,
+        "Latest" only the newest message per destination
+        - rate: maximum number of messages per second to replay
+        Raises:
+        - ValueError if replay is not supported or max_messages or rate is
+        not positive.
+        """
+        if replay not in REPLAY_MODES:
+            raise ValueError("Unsupported replay mode {}, must be one of {}"
+                             .format(replay, REPLAY_MODES))
+        if max_messages < 1 or rate <= 0:
+            raise ValueError("Spool size and rate must be > 0: {}, {}"
+                             .format(max_messages, rate))
+        self.log = logging.getLogger(type(self).__name__)
+        self.max_messages = max_messages
+        self.replay_mode = replay
+        self.rate = rate
+        self.lock = Lock()
+        self.replaying = None
+        self.stop_replay = Event()
+        self.dropped = 0
+        # Set by close() under the lock, the database can't be used after.
+        self.closed = False
+        # True under the lock from replay() until the replay stops, see
+        # put_behind.
+        self.active = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Fewer fsyncs to spare the SD card, WAL keeps the database consistent.
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS spool ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "destination TEXT NOT NULL, message BLOB)")
+        self.count = self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        if self.count:
+            self.log.info("Found %d spooled messages in %s", self.count, path)
+
+    def put(self, message, destination):
+        """Appends message to the spool, dropping the oldest messages if the
+        spool is full. Messages put after close() or that fail to be written
+        are logged and counted as dropped.
+        """
+        with self.lock:
+            self._put(message, destination)
+
+    def put_behind(self, message, destination):
+        """Appends message to the spool if a replay is running so it isn't
+        published before the older spooled messages. Returns True if it was
+        spooled, False if it can be published right away.
+        """
+        with self.lock:
+            if not self.active:
+                return False
+            self._put(message, destination)
+            return True
+
+    def _put(self, message, destination):
+        """Appends message to the spool, must be called with the lock held."""
+        if self.closed:
+            self.dropped += 1
+            self.log.warning("Spool is closed, dropping message to %s",
+                             destination)
+            return
+        try:
+            self.db.execute("INSERT INTO spool (destination, message) "
+                            "VALUES (?, ?)", (destination, message))
+        except sqlite3.Error:
+            self.dropped += 1
+            self.log.error("Error spooling message to %s: %s",
+                           destination, traceback.format_exc())
+            return
+        self.count += 1
+        if self.count > self.max_messages:
+            excess = self.count - self.max_messages
+            try:
+                self.db.execute("DELETE FROM spool WHERE id IN (SELECT id "
+                                "FROM spool ORDER BY id LIMIT ?)",
+                                (excess,))
+            except sqlite3.Error:
+                self.log.error("Error trimming the spool: %s",
+                               traceback.format_exc())
+                return
+            self.count -= excess
+            self.dropped += excess
+
+    def __len__(self):
+        return self.count
+
+    def replay(self, publish, is_connected):
+        """Starts a thread that calls publish(message, destination) for the
+        spooled messages, no faster than the configured rate, and removes them
+        from the spool, including the ones put_behind adds meanwhile. Stops
+        early if is_connected() returns False. Does nothing if a replay is
+        already running or the spool is empty.
+        """
+        with self.lock:
+            if (not self.count or self.closed
+                    or (self.replaying and self.replaying.is_alive())):
+                return
+            self.active = True
+        self.stop_replay.clear()
+        self.replaying = Thread(target=self._replay,
+                                args=(publish, is_connected),
+                                name="spool-replay", daemon=True)
+        self.replaying.start()
+
+    def _replay(self, publish, is_connected):
+        """Replays the spool in batches until it's empty, the connection drops
+        or the spool is closed.
+        """
+        self.log.info("Replaying %d spooled messages (%s)", self.count,
+                      self.replay_mode)
+        interval = 1.0 / self.rate
+        try:
+            while not self.stop_replay.is_set() and is_connected():
+                with self.lock:
+                    if self.closed:
+                        return
+                    if self.replay_mode == "Latest":
+                        rows = self.db.execute(
+                            "SELECT id, destination, message FROM spool WHERE "
+                            "id IN (SELECT MAX(id) FROM spool GROUP BY "
+                            "destination) ORDER BY id").fetchall()
+                    else:
+                        rows = self.db.execute(
+                            "SELECT id, destination, message FROM spool "
+                            "ORDER BY id LIMIT 100").fetchall()
+                    if not rows:
+                        # Checked under the lock so put_behind can't add a
+                        # message the replay won't see.
+                        self.active = False
+                        return
+
+                sent = None
+                for row_id, destination, message in rows:
+                    if self.stop_replay.is_set() or not is_connected():
+                        break
+                    publish(message, destination)
+                    sent = row_id
+                    self.stop_replay.wait(interval)
+
+                if sent is not None:
+                    with self.lock:
+                        if self.closed:
+                            return
+                        # In Latest mode everything up to the last replayed
+                        # message is superseded.
+                        cur = self.db.execute("DELETE FROM spool WHERE id <= ?",
+                                              (sent,))
+                        self.count -= cur.rowcount
+        except sqlite3.Error:
+            self.log.error("Error replaying the spool: %s",
+                           traceback.format_exc())
+        finally:
+            with self.lock:
+                self.active = False
+            self.log.info("Spool replay stopped, %d messages left", self.count)
+
+    def close(self):
+        """Stops a running replay and closes the database."""
+        self.stop_replay.set()
+        if self.replaying:
+            self.replaying.join(5)
+        with self.lock:
+            self.closed = True
+            self.db.close()
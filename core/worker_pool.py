@@ -0,0 +1,105 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contains a fixed size pool of worker threads used to run sensor checks.
+
+Classes: WorkerPool
+"""
+import logging
+import time
+import traceback
+from concurrent.futures import Executor, Future
+from queue import Queue
+from threading import Thread, Lock
+
+class WorkerPool(Executor):
+    """A fixed number of daemon threads that pull jobs off of a shared queue.
+    The threads are daemons so a job that never returns can not keep the
+    program from exiting. It is an Executor so it can also be handed to an
+    asyncio loop's run_in_executor.
+    """
+
+    def __init__(self, workers, name="worker"):
+        """Starts the worker threads.
+
+        Arguments:
+        - workers: number of threads to start, must be > 0
+        - name: prefix used to name the threads
+        Raises:
+        - ValueError if workers is < 1.
+        """
+        if workers < 1:
+            raise ValueError("A worker pool needs at least one worker: {}"
+                             .format(workers))
+        self.log = logging.getLogger(type(self).__name__)
+        self.jobs = Queue()
+        self.lock = Lock()
+        self.busy = 0
+        self.threads = []
+        for i in range(workers):
+            thread = Thread(target=self._work, name="{}-{}".format(name, i),
+                            daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        """Runs the queued jobs until the None sentinel is received."""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            future, target, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                self.busy += 1
+            try:
+                future.set_result(target(*args, **kwargs))
+            except BaseException as ex:
+                self.log.debug("Error in worker: %s", traceback.format_exc())
+                future.set_exception(ex)
+            finally:
+                with self.lock:
+                    self.busy -= 1
+
+    def submit(self, target, *args, **kwargs):
+        """Queues target to be called with args on one of the workers and
+        returns the Future for the result.
+        """
+        future = Future()
+        self.jobs.put((future, target, args, kwargs))
+        return future
+
+    def queue_depth(self):
+        """Returns the number of jobs waiting for a free worker."""
+        return self.jobs.qsize()
+
+    def shutdown(self, wait=True, *, cancel_futures=False, timeout=None):
+        """Tells the workers to exit once the queued jobs are done and, when
+        wait is True, waits up to timeout seconds in total for them. Returns
+        the threads that are still running.
+        """
+        if cancel_futures:
+            while not self.jobs.empty():
+                job = self.jobs.get_nowait()
+                if job:
+                    job[0].cancel()
+        for _ in self.threads:
+            self.jobs.put(None)
+        if wait:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            for thread in self.threads:
+                thread.join(None if deadline is None
+                            else max(deadline - time.monotonic(), 0))
+        return [thread for thread in self.threads if thread.is_alive()]
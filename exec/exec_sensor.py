@@ -44,9 +44,7 @@ class ExecSensor(Sensor):
         self.log.debug("Executing with arguments %s", self.cmd_args)
 
         try:
-            self.results = subprocess.check_output(self.cmd_args, shell=False,
-                                                   universal_newlines=True,
-                                                   timeout=self.poll).rstrip()
+            self.results = self._run_script().rstrip()
             self.log.info("Command results to be published to %s\n%s",
                           self.destination, self.results)
         except subprocess.CalledProcessError as ex:
@@ -55,9 +53,37 @@ class ExecSensor(Sensor):
         except subprocess.TimeoutExpired:
             self.log.error("Command took longer than %d to complete!", self.poll)
             self.results = "ERROR"
+        except InterruptedError:
+            self.log.info("Command killed, sensor_reporter is stopping")
+            return
 
         self.publish_state()
 
+    def _run_script(self):
+        """Runs the script and returns its output like subprocess.check_output
+        with a timeout of the polling period. The script is killed and
+        InterruptedError raised if sensor_reporter stops while it runs.
+        """
+        deadline = time.monotonic() + self.poll
+        with subprocess.Popen(self.cmd_args, shell=False, stdout=subprocess.PIPE,
+                              universal_newlines=True) as proc:
+            while True:
+                try:
+                    output = proc.communicate(
+                        timeout=max(min(deadline - time.monotonic(), 0.5), 0))[0]
+                    break
+                except subprocess.TimeoutExpired:
+                    if self.stop_event.is_set():
+                        proc.kill()
+                        raise InterruptedError()
+                    if time.monotonic() >= deadline:
+                        proc.kill()
+                        raise
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, self.cmd_args,
+                                                output)
+        return output
+
     def publish_state(self):
         """Publishes the most recent results from the script."""
         self._send(self.results, self.destination)
@@ -17,7 +17,7 @@ Classes:
     - RpiGpioSensor: Reports on the state of a GPIO Pin.
     - RpiGpioActuator: Sets a pin to HIGH or LOW on command.
 """
-from time import sleep
+from time import sleep, monotonic
 from configparser import NoOptionError
 from distutils.util import strtobool
 import datetime
@@ -67,6 +67,8 @@ class RpiGpioSensor(Sensor):
             to poll it will reliy on the event detection built into the GPIO
             library. Valid values are "RISING", "FALLING" and "BOTH". When not
             defined "Poll" must be set to a positive value.
+            - "Debounce": optional time in milliseconds during which further
+            edges after an event are ignored, for bouncy contacts.
         """
         super().__init__(publishers, params)
 
@@ -103,8 +105,13 @@ class RpiGpioSensor(Sensor):
             event_detection = "NONE"
 
         if event_detection != "NONE":
-            GPIO.add_event_detect(self.pin, event_map[event_detection],
-                                  callback=lambda channel: self.check_state())
+            try:
+                GPIO.add_event_detect(self.pin, event_map[event_detection],
+                                      callback=self._on_edge,
+                                      bouncetime=int(params("Debounce")))
+            except NoOptionError:
+                GPIO.add_event_detect(self.pin, event_map[event_detection],
+                                      callback=self._on_edge)
 
         self.state = GPIO.input(self.pin)
 
@@ -122,19 +129,31 @@ class RpiGpioSensor(Sensor):
 
         self.publish_state()
 
-    def check_state(self):
+    def _on_edge(self, channel):
+        """Called by the GPIO library's event thread on an edge. The time is
+        taken first so button press durations don't depend on how long it took
+        to get here.
+        """
+        timestamp = monotonic()
+        with self.aggregating():
+            self.check_state(timestamp)
+
+    def check_state(self, timestamp=None):
         """Checks the current state of the pin and if it's different from the
         last state publishes it. With event detection this method gets called
         when the GPIO pin changed states. When polling this method gets called
-        on each poll.
+        on each poll. timestamp is the monotonic time of the edge, defaults to
+        now.
         """
+        if timestamp is None:
+            timestamp = monotonic()
         value = GPIO.input(self.pin)
         if value != self.state:
             self.log.info("Pin %s (%s) changed from %s to %s (= %s)",
                           self.pin, self.gpio_mode, self.state, value, self.values[value])
             self.state = value
             self.publish_state()
-            self.btn.check_button_press(self)
+            self.btn.check_button_press(self, timestamp)
 
     def publish_state(self):
         """Publishes the current state of the pin."""
@@ -156,9 +175,9 @@ class RpiGpioSensor(Sensor):
         self.log.debug("Cleaning up GPIO inputs, invoked via Pin %d (%s)",
                        self.pin, self.gpio_mode)
         GPIO.remove_event_detect(self.pin)
-        # make sure cleanup runs only once
+        # only release this pin so a reload doesn't reset the other ones
         if GPIO.getmode() is not None:
-            GPIO.cleanup()
+            GPIO.cleanup(self.pin)
 
 class ButtonPressCfg():
     """ stores all button related parameters
@@ -201,13 +220,14 @@ class ButtonPressCfg():
             #remember expacted state for contact closed
             self.state_when_pressed = GPIO.LOW if pud == GPIO.PUD_UP else GPIO.HIGH
 
-    def check_button_press(self, caller):
+    def check_button_press(self, caller, timestamp):
         """checks the duration the contact was closed and
          rises the event configured with that duration
 
          Parameter:
              - caller : the object of the caller
                         so self.log and self.publish_button_state can be accessed
+             - timestamp : monotonic time of the pin change
          """
         #if dest_short_press is not configured exit
         if self.dest_short_press is None:
@@ -215,13 +235,13 @@ class ButtonPressCfg():
 
         #get time during button was closed
         if caller.state == self.state_when_pressed:
-            self.high_time = datetime.datetime.now()
+            self.high_time = timestamp
         elif self.high_time is None:
             caller.log.warning("Expected contact closed before release."
                                " 'Btn_Pressed_State' is probably configured wrong"
                                " for Pin: %s, Destination: %s", caller.pin, caller.destination)
         else:
-            time_delta_seconds = (datetime.datetime.now() - self.high_time).total_seconds()
+            time_delta_seconds = timestamp - self.high_time
             if time_delta_seconds > self.short_press_time:
                 if self.long_press_time != 0 and time_delta_seconds > self.long_press_time:
                     caller.log.info("Long button press occured on Pin %s (%s)"
@@ -353,8 +373,8 @@ class RpiGpioActuator(Actuator):
                           self.highlow_to_str(self.init_state),
                           self.highlow_to_str(not self.init_state))
             GPIO.output(self.pin, int(not self.init_state))
-            #  "sleep" will block a local connecten and therefore
-            # distort the time detection of button press event's
+            # The local connection calls this on the destination's own
+            # dispatch thread, so the sleep doesn't hold up the sensor
             sleep(.5)
             self.log.info("Toggling pin %s (%s) %s to %s",
                           self.pin, self.gpio_mode,
@@ -398,9 +418,9 @@ class RpiGpioActuator(Actuator):
         """Disconnects from the GPIO subsystem."""
         self.log.debug("Cleaning up GPIO outputs, invoked via Pin %d (%s)",
                        self.pin, self.gpio_mode)
-        # make sure cleanup runs only once
+        # only release this pin so a reload doesn't reset the other ones
         if GPIO.getmode() is not None:
-            GPIO.cleanup()
+            GPIO.cleanup(self.pin)
 
     @staticmethod
     def highlow_to_str(output):
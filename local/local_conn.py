@@ -18,12 +18,21 @@ Classes:
     - LocalConnection: allows sensors to call local actuators.
 """
 from configparser import NoOptionError
+from threading import Lock, Timer, current_thread
+import traceback
+from time import monotonic
 from core.connection import Connection
-from core.utils import is_toggle_cmd
+from core.utils import is_toggle_cmd, get_sequential_params
+from core.worker_pool import WorkerPool
+from local.rules import compile_rule, compare_rule
 
 class LocalConnection(Connection):
     """A special connection that can link Sensors and Actuators to other
-    Actuators. One of three optional parameters can be provided:
+    Actuators. Messages can be translated by rules before they are passed on,
+    see local.rules for the rule language. "Rule" applies to all destinations,
+    "Destination<n>"/"Rule<n>" pairs override it for single destinations.
+    "Hysteresis" and "MinDwell" suppress flapping around a threshold. One
+    of three legacy parameters can be provided instead of "Rule":
     "OnEq": if message equal to this parameter is received publish "ON", works
     with String messages
     "OnGT": if the message is greater than this value, publsih "ON", only works
@@ -31,10 +40,13 @@ class LocalConnection(Connection):
     "OnLT": if the message is less than this value, publish "ON", only works
     with messages that can be parsed to float.
 
-    If none of the optional parameters are present, the message is passes as is.
+    If no rule applies to a destination, the message is passes as is.
     All messages that don't match the comparison results in "OFF". If more than
     one is defined, OnEQ is first and OnGT is second and OnLT is last.
 
+    The handlers are called on a thread per destination, in the order the
+    messages were published, so a slow actuator doesn't block the sensors.
+
     This can be used to, for example, turn on an LED attached to a GPIO pin
     configured with RpiGpioActuator when a sensor has a given value.
     Configure this as a connection and configure both the sensor and the
@@ -42,10 +54,26 @@ class LocalConnection(Connection):
     """
 
     def __init__(self, msg_processor, params):
-        """Initializes a local connection. Supports a few simple comparisons
-        which can cause the incoming message to be translated to ON/OFF.
+        """Initializes a local connection. The rules are compiled once here so
+        handling a message is a single call.
 
         Params:
+            - "Rule": optional rule applied to the messages of every
+            destination without a rule of its own.
+            - "Destination<n>" and "Rule<n>": optional, the rule in Rule<n>
+            applies to the messages published to Destination<n>, n counting
+            from 1.
+            - "Hysteresis": optional band for numeric messages. The result of
+            the rule only changes when the rule gives the new result for the
+            message plus and minus this value.
+            - "MinDwell": optional minimum seconds between two changes of the
+            result. A change arriving sooner is forwarded when the time is up,
+            unless the result changed back meanwhile.
+            - "Hysteresis<n>" and "MinDwell<n>": optional, override Hysteresis
+            and MinDwell for Destination<n>.
+            When Hysteresis or MinDwell is set for a destination only changes of
+            the result are forwarded. After a TOGGLE the next result is always
+            forwarded as the actuator's state is no longer known.
             - "OnEq": any message that matches will be converted to "ON" and all
             other messages will result in "OFF".
             - "OnGT": assumes the message is a number, if the incoming message
@@ -55,64 +83,198 @@ class LocalConnection(Connection):
             is less than the parameter value "ON" is published; in all other
             cases "OFF" is published.
 
-        If more than one of the above is present, the first one found in the
-        order listed above will be used and the others ignored.
+        If more than one of "Rule", "OnEq", "OnGT" and "OnLT" is present, the
+        first one found in the order listed above will be used and the others
+        ignored.
 
         If none of the above parameters are defined, the message is published
         unmodified.
 
         The mqg_processor parameter is ignored, this connection cannot cause
         sensor_reporter to republish the sensor values.
+
+        Raises:
+            - ValueError if a rule is invalid.
         """
         super().__init__(msg_processor, params)
 
-        self.eq = None
-        self.gt = None
-        self.lt = None
+        def get(key, conv=str):
+            try:
+                return conv(params(key))
+            except NoOptionError:
+                return None
 
-        try:
-            self.eq = params("OnEq")
-        except NoOptionError:
-            pass
-        try:
-            if not self.eq:
-                self.gt = float(params("OnGT"))
-        except NoOptionError:
-            pass
-        try:
-            if not self.eq and not self.gt:
-                self.lt = float(params("OnLT"))
-        except NoOptionError:
-            pass
+        rule = get("Rule")
+        if rule is not None:
+            self.default_rule = compile_rule(rule)
+        else:
+            self.default_rule = compare_rule(get("OnEq"), get("OnGT", float),
+                                             get("OnLT", float))
+        self.default_band = (get("Hysteresis", float), get("MinDwell", float))
+        self.rules = {}
+        self.bands = {}
+        for i, dest in enumerate(get_sequential_params(params, "Destination"),
+                                 1):
+            rule = get("Rule{}".format(i))
+            if rule is not None:
+                self.rules[dest] = compile_rule(rule)
+            band = (get("Hysteresis{}".format(i), float),
+                    get("MinDwell{}".format(i), float))
+            if band != (None, None):
+                self.bands[dest] = band
+        # Last message published per destination, for the @dest references.
+        self.values = {}
+        # Last result forwarded, the monotonic time it changed and the Timer of
+        # a change waiting for MinDwell, per destination with a Hysteresis or
+        # MinDwell.
+        self.states = {}
+        self.lock = Lock()
+        # One single threaded executor per registered destination
+        self.dispatchers = {}
+
+    def _transition(self, destination, message, send, rule):
+        """Returns send if it's a change of the destination's result that
+        passes its hysteresis band and minimum dwell time, None otherwise. A
+        change that only fails the dwell time is scheduled to be forwarded
+        when it's up, a result going back to the forwarded one cancels it.
+        """
+        band, dwell = self.bands.get(destination, self.default_band)
+        now = monotonic()
+        with self.lock:
+            state = self.states.get(destination)
+            if state is None:
+                self.states[destination] = [send, now, None]
+                return send
+            if send == state[0]:
+                self._cancel_pending(state)
+                return None
+            if band and rule:
+                try:
+                    num = float(message)
+                except ValueError:
+                    num = None
+                if num is not None and (
+                        rule(str(num - band), self.values) != send
+                        or rule(str(num + band), self.values) != send):
+                    return None
+            self._cancel_pending(state)
+            if dwell and now - state[1] < dwell:
+                state[2] = Timer(state[1] + dwell - now, self._apply_pending,
+                                 args=(destination, send))
+                state[2].daemon = True
+                state[2].start()
+                return None
+            state[0] = send
+            state[1] = now
+            return send
+
+    @staticmethod
+    def _cancel_pending(state):
+        """Cancels the change of state waiting for the dwell time, if any.
+        Must be called with the lock held.
+        """
+        if state[2]:
+            state[2].cancel()
+            state[2] = None
+
+    def _apply_pending(self, destination, send):
+        """Called by the Timer when the dwell time of destination is up,
+        forwards send unless the change was cancelled meanwhile.
+        """
+        with self.lock:
+            state = self.states.get(destination)
+            # Only the Timer still pending, not one cancelled or replaced.
+            if state is None or state[2] is not current_thread():
+                return
+            state[0] = send
+            state[1] = monotonic()
+            state[2] = None
+        self.log.info("Forwarding %s to %s after the dwell time", send,
+                      destination)
+        self._forward(destination, send)
+
+    def _forward(self, destination, send):
+        """Hands send to the handler of destination on its dispatch thread."""
+        handler = self.registered.get(destination)
+        dispatcher = self.dispatchers.get(destination)
+        if handler and dispatcher:
+            dispatcher.submit(self._deliver, handler, send, destination)
 
     def publish(self, message, destination, filter_echo=False):
-        """Send the message or, if defined, translate the message to ON or OFF."""
+        """Send the message or, if defined, translate the message with the
+        destination's rule.
+        """
         if filter_echo:
             # ignore msg since the local connection doesn't need updates of the actuator state
             return
 
-        if destination in self.registered:
+        self.values[destination] = message
+        handler = self.registered.get(destination)
+        if handler:
             try:
                 send = message
+                rule = self.rules.get(destination, self.default_rule)
                 # forward TOGGLE and ISO formated time messages
                 if is_toggle_cmd(message):
                     send = "TOGGLE"
-                elif self.eq and message == self.eq:
-                    send = "ON"
-                elif self.eq:
-                    send = "OFF"
-                elif self.gt and float(message) > self.gt:
-                    send = "ON"
-                elif self.gt:
-                    send = "OFF"
-                elif self.lt and float(message) < self.lt:
-                    send = "ON"
-                elif self.lt:
-                    send = "OFF"
+                    with self.lock:
+                        # The state the actuator toggled to isn't known.
+                        state = self.states.pop(destination, None)
+                        if state:
+                            self._cancel_pending(state)
+                else:
+                    if rule:
+                        send = rule(message, self.values)
+                    if (destination in self.bands
+                            or self.default_band != (None, None)):
+                        send = self._transition(destination, message, send,
+                                                rule)
+                        if send is None:
+                            self.log.debug("Message %s to %s is not a "
+                                           "transition", message, destination)
+                            return
                 self.log.info("Received message %s, forwarding %s to %s", message,
                               send, destination)
-                self.registered[destination](send)
+                self._forward(destination, send)
             except ValueError:
                 self.log.error("'%s' cannot be parsed to float!", message)
         else:
             self.log.debug("There is no handler registered for %s", destination)
+
+    def _deliver(self, handler, send, destination):
+        """Calls handler with send on the destination's dispatch thread."""
+        try:
+            handler(send)
+        except Exception:
+            self.log.error("Error handling %s on %s: %s", send, destination,
+                           traceback.format_exc())
+
+    def register(self, destination, handler):
+        """Registers handler and starts the dispatch thread of destination."""
+        super().register(destination, handler)
+        with self.lock:
+            if destination not in self.dispatchers:
+                self.dispatchers[destination] = WorkerPool(
+                    1, "local-{}".format(destination))
+
+    def unregister(self, destination, handler=None):
+        """Removes the handler, the dispatch thread stops once the queued
+        messages are handled.
+        """
+        super().unregister(destination, handler)
+        with self.lock:
+            if destination in self.registered:
+                return
+            dispatcher = self.dispatchers.pop(destination, None)
+        if dispatcher:
+            dispatcher.shutdown(wait=False)
+
+    def disconnect(self):
+        """Waits briefly for the queued messages to be handled."""
+        with self.lock:
+            for state in self.states.values():
+                self._cancel_pending(state)
+            dispatchers = list(self.dispatchers.values())
+            self.dispatchers = {}
+        for dispatcher in dispatchers:
+            dispatcher.shutdown(timeout=1)
@@ -0,0 +1,296 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compiles the rules LocalConnection uses to translate messages before they
+are passed to the local actuators.
+
+A rule is either a condition, which translates the message to "ON" when true
+and "OFF" otherwise, or a value map. Conditions support:
+    - comparisons: value > 20, value == OPEN, @door != 'CLOSED'
+    with ==, !=, >, >=, < and <=
+    - ranges: value in 18..22, both ends included
+    - and, or, not and parentheses: value > 25 and @window == CLOSED
+`value` is the received message, `@dest` the last message published to dest
+on the same connection. Numbers are compared as numbers, anything else as
+strings; quote strings with ' or " if they contain spaces or symbols.
+
+A value map translates the message with a lookup table, `*` is the default
+for everything else, without it unmatched messages pass unchanged:
+    {OPEN: ON, CLOSED: OFF, *: OFF}
+
+Functions:
+    - compile_rule: Returns the callable for a rule.
+    - compare_rule: Returns the callable for a single legacy comparison.
+"""
+import operator
+import re
+
+ON = "ON"
+OFF = "OFF"
+
+_TOKENS = re.compile(r"""\s*(?:
+    (?P<num>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?!\w|\.(?!\.)))
+    |(?P<str>'[^']*'|"[^"]*")
+    |(?P<op>==|!=|>=|<=|>|<|\.\.|[(){}:,*])
+    |(?P<ref>@[^\s()=!<>,{}:]+)
+    |(?P<word>[^\s()=!<>,{}:'"]+)
+    )""", re.VERBOSE)
+
+_COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le
+}
+
+def _tokenize(text):
+    """Returns the list of (kind, text) tokens of text."""
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKENS.match(text, pos)
+        if not match or match.end() == pos:
+            raise ValueError("Invalid rule '{}' at '{}'".format(text,
+                                                                text[pos:]))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+def _number(msg):
+    """Returns msg as a float, None if it isn't a number."""
+    try:
+        return float(msg)
+    except (TypeError, ValueError):
+        return None
+
+class _Parser:
+    """Recursive descent parser turning the tokens of a rule into nested
+    closures taking (value, values) so evaluating a rule is plain function
+    calls.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None,
+                                                                         None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError("Unexpected end of rule '{}'".format(self.text))
+        self.pos += 1
+        return token
+
+    def _expect(self, text):
+        kind, tok = self._next()
+        if tok != text or kind == "str":
+            raise ValueError("Expected '{}' but found '{}' in rule '{}'"
+                             .format(text, tok, self.text))
+
+    def _keyword(self, word):
+        """Consumes and returns True if the next token is the keyword word."""
+        kind, tok = self._peek()
+        if kind == "word" and tok.lower() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def parse(self):
+        """Returns the callable for the whole rule."""
+        if self._peek()[1] == "{":
+            rule = self._value_map()
+        else:
+            cond = self._or()
+            rule = lambda value, values: ON if cond(value, values) else OFF
+        if self._peek()[0] is not None:
+            raise ValueError("Unexpected '{}' in rule '{}'"
+                             .format(self._peek()[1], self.text))
+        return rule
+
+    def _value_map(self):
+        self._expect("{")
+        table = {}
+        default = None
+        while True:
+            kind, key = self._next()
+            self._expect(":")
+            val = self._literal_text()
+            if key == "*" and kind == "op":
+                default = val
+            else:
+                table[key[1:-1] if kind == "str" else key] = val
+            if self._peek()[1] == "}":
+                break
+            self._expect(",")
+        self._expect("}")
+        if default is None:
+            return lambda value, values: table.get(value, value)
+        return lambda value, values: table.get(value, default)
+
+    def _literal_text(self):
+        kind, tok = self._next()
+        if kind not in ("num", "str", "word"):
+            raise ValueError("Expected a value but found '{}' in rule '{}'"
+                             .format(tok, self.text))
+        return tok[1:-1] if kind == "str" else tok
+
+    def _or(self):
+        terms = [self._and()]
+        while self._keyword("or"):
+            terms.append(self._and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda value, values: any(term(value, values) for term in terms)
+
+    def _and(self):
+        terms = [self._not()]
+        while self._keyword("and"):
+            terms.append(self._not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda value, values: all(term(value, values) for term in terms)
+
+    def _not(self):
+        if self._keyword("not"):
+            term = self._not()
+            return lambda value, values: not term(value, values)
+        if self._peek() == ("op", "("):
+            self._next()
+            term = self._or()
+            self._expect(")")
+            return term
+        return self._comparison()
+
+    def _operand(self):
+        """Returns (getter, literal) where literal is the constant value or
+        None when the operand is only known at run time.
+        """
+        kind, tok = self._next()
+        if kind == "ref":
+            dest = tok[1:]
+            return (lambda value, values: values.get(dest)), None
+        if kind == "word" and tok == "value":
+            return (lambda value, values: value), None
+        if kind == "num":
+            num = float(tok)
+            return (lambda value, values: num), num
+        if kind in ("str", "word"):
+            text = tok[1:-1] if kind == "str" else tok
+            return (lambda value, values: text), text
+        raise ValueError("Expected a value but found '{}' in rule '{}'"
+                         .format(tok, self.text))
+
+    def _check_operands(self, left_lit, right_lit):
+        """Raises ValueError if neither side of a comparison is value or an
+        @dest reference, e.g. a misspelled value, as the result would never
+        depend on the message.
+        """
+        if left_lit is not None and right_lit is not None:
+            raise ValueError("Comparison of two constants in rule '{}', use "
+                             "value or @dest on one side".format(self.text))
+
+    def _comparison(self):
+        left, left_lit = self._operand()
+        if self._keyword("in"):
+            _, low_lit = self._operand()
+            self._expect("..")
+            _, high_lit = self._operand()
+            if not isinstance(low_lit, float) or not isinstance(high_lit,
+                                                                 float):
+                raise ValueError("Range bounds must be numbers in rule '{}'"
+                                 .format(self.text))
+            self._check_operands(left_lit, low_lit)
+
+            def in_range(value, values):
+                num = _number(left(value, values))
+                if num is None:
+                    raise ValueError("'{}' cannot be parsed to float!"
+                                     .format(value))
+                return low_lit <= num <= high_lit
+            return in_range
+
+        kind, tok = self._next()
+        if kind != "op" or tok not in _COMPARISONS:
+            raise ValueError("Expected a comparison but found '{}' in rule "
+                             "'{}'".format(tok, self.text))
+        compare = _COMPARISONS[tok]
+        right, right_lit = self._operand()
+        self._check_operands(left_lit, right_lit)
+        ordering = tok not in ("==", "!=")
+
+        if isinstance(left_lit, float) or isinstance(right_lit, float):
+            # A number on one side, compare as numbers.
+            def numeric(value, values):
+                lval = _number(left(value, values))
+                rval = _number(right(value, values))
+                if lval is None or rval is None:
+                    if ordering:
+                        raise ValueError("'{}' cannot be parsed to float!"
+                                         .format(value))
+                    return tok == "!="
+                return compare(lval, rval)
+            return numeric
+
+        if left_lit is not None or right_lit is not None:
+            # A string on one side, compare as strings.
+            if ordering:
+                raise ValueError("Can't order strings in rule '{}'"
+                                 .format(self.text))
+            return lambda value, values: compare(left(value, values),
+                                                 right(value, values))
+
+        def dynamic(value, values):
+            # Only known at run time, numbers if both are numbers.
+            lval = left(value, values)
+            rval = right(value, values)
+            lnum = _number(lval)
+            rnum = _number(rval)
+            if lnum is not None and rnum is not None:
+                return compare(lnum, rnum)
+            if ordering:
+                raise ValueError("'{}' cannot be parsed to float!"
+                                 .format(value))
+            return compare(lval, rval)
+        return dynamic
+
+def compile_rule(text):
+    """Compiles the rule text into a callable taking the received message and
+    a dict of the last message per destination and returning the message to
+    forward.
+
+    Raises:
+    - ValueError if the rule is invalid or compares two constants. The callable
+    raises ValueError when a message that isn't a number is compared with > or
+    < or tested with in.
+    """
+    return _Parser(text).parse()
+
+def compare_rule(eq=None, gt=None, lt=None):
+    """Returns the callable for the legacy OnEq, OnGT and OnLT parameters, the
+    first one not None is used. OnEq compares the message as a string.
+    """
+    if eq is not None:
+        return lambda value, values: ON if value == eq else OFF
+    if gt is not None:
+        return lambda value, values: ON if float(value) > gt else OFF
+    if lt is not None:
+        return lambda value, values: ON if float(value) < lt else OFF
+    return None
@@ -14,21 +14,79 @@
 
 """Contains the MQTT connection class.
 
-Classes: MqttConnection
+Classes: MqttConnection, EchoFilter
 """
+from collections import OrderedDict
 from configparser import NoOptionError
-import socket
+import os
+import random
 import traceback
-from time import sleep
+from threading import Lock
+from time import monotonic
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from core.connection import Connection
-import datetime
+from core.spool import MessageSpool
+from mqtt.topic_trie import TopicTrie
 
 LWT = "status"
 REFRESH = "refresh"
 ONLINE = "ONLINE"
 OFFLINE = "OFFLINE"
 
+# Seconds an echo of our own publish is expected back from the broker.
+ECHO_TTL = 1
+# Maximum number of outstanding echoes remembered.
+ECHO_MAX = 1000
+
+
+class EchoFilter:
+    """Remembers recently published (topic, message) pairs so their echo from
+    the broker can be ignored. Entries expire after ttl seconds and the oldest
+    are dropped beyond max_entries, so unanswered publishes don't pile up.
+    """
+
+    def __init__(self, ttl=ECHO_TTL, max_entries=ECHO_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Kept in expiry order: the TTL is fixed and re-added entries are
+        # moved to the end.
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def _expire(self, now):
+        """Drops the expired entries. Must be called with the lock held."""
+        while self.entries:
+            key, expires = next(iter(self.entries.items()))
+            if expires > now:
+                return
+            del self.entries[key]
+
+    def add(self, topic, message):
+        """Remembers that message was just published to topic."""
+        now = monotonic()
+        with self.lock:
+            self._expire(now)
+            key = (topic, message)
+            self.entries[key] = now + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def is_echo(self, topic, message):
+        """Returns True and forgets the entry if message on topic is the echo
+        of a recent publish.
+        """
+        if not self.entries:
+            return False
+        with self.lock:
+            self._expire(monotonic())
+            return self.entries.pop((topic, message), None) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
 
 class MqttConnection(Connection):
     """Connects to and enables subscription and publishing to MQTT."""
@@ -50,9 +108,41 @@ class MqttConnection(Connection):
         - "User": MQTT broker login user name
         - "Password": MQTT broker login password
         - "Keepalive": MQTT keepalive parameter
-
-        If the connection fails, it will keep retrying every five seconds until
-        the connection is successful.
+        - "SpoolDir": Optional directory for a persistent spool of the
+        messages published while disconnected. Replaces BufferOffline.
+        - "SpoolMaxMessages": Optional cap on the spooled messages, the oldest
+        are dropped first. Default is 10000.
+        - "SpoolReplay": Optional, "Ordered" (default) replays every spooled
+        message in order on reconnect, "Latest" only the newest per topic.
+        - "SpoolRate": Optional maximum messages per second replayed, default
+        is 10.
+        - "SubscribeTopic": Optional topic filter below RootTopic, e.g. "#".
+        When set, one subscription to RootTopic/SubscribeTopic replaces the
+        subscriptions of the registered topics it covers.
+        - "QoS": Optional QoS of the publishes and subscriptions, default is 0.
+        - "DestinationQoS": Optional comma separated destination:qos pairs
+        overriding QoS for individual destinations, e.g. "temp:1,humidity:1".
+        - "MaxInflight": Optional number of QoS 1 and 2 messages that may be
+        awaiting acknowledgement at the same time, paho's default is 20.
+        - "MaxQueued": Optional number of QoS 1 and 2 messages paho keeps,
+        including the ones queued while disconnected, default is 1000, 0 for
+        no limit. Messages published when it is full are dropped.
+        - "Protocol": Optional MQTT protocol version, "3.1.1" (default) or "5".
+        - "TopicAliases": Optional, MQTT 5 only, maximum number of topic
+        aliases to use for frequently published topics, capped by the broker's
+        maximum. Default is 10, 0 disables them.
+        - "MessageExpiry": Optional, MQTT 5 only, seconds after which the
+        broker discards a non-retained message not yet delivered.
+        - "UserProperties": Optional, MQTT 5 only, comma separated name:value
+        pairs sent as user properties with every message.
+        - "ReconnectMin": Optional seconds to wait before the first reconnect
+        attempt, default is 1.
+        - "ReconnectMax": Optional cap on the seconds between reconnect
+        attempts, default is 120. Each delay gets up to 50% random jitter.
+
+        The connection is made in the background by the MQTT network thread so
+        startup is not held up when the broker is down. Failed attempts are
+        retried with a doubling delay between ReconnectMin and ReconnectMax.
 
         RootTopic/status is the LWT topic and will have ONLINE/OFFLINE published
         as a retained message to indicate the online status of this connection.
@@ -67,6 +157,13 @@ class MqttConnection(Connection):
         self.port = int(params("Port"))
         client_name = params("Client")
         self.root_topic = params("RootTopic")
+        try:
+            self.subscription = "{}/{}".format(self.root_topic,
+                                               params("SubscribeTopic"))
+        except NoOptionError:
+            self.subscription = None
+        # Registered topic filters and their handlers
+        self.handlers = TopicTrie()
         try:
             tls = params("TLS").lower()
         except NoOptionError:
@@ -82,11 +179,83 @@ class MqttConnection(Connection):
         user = params("User")
         passwd = params("Password")
         self.keepalive = int(params("Keepalive"))
+        try:
+            self.qos = int(params("QoS"))
+        except NoOptionError:
+            self.qos = 0
+        self.dest_qos = {}
+        try:
+            for pair in params("DestinationQoS").split(","):
+                dest, qos = pair.rsplit(":", 1)
+                self.dest_qos[dest.strip()] = int(qos)
+        except NoOptionError:
+            pass
+        try:
+            self.reconnect_min = float(params("ReconnectMin"))
+        except NoOptionError:
+            self.reconnect_min = 1
+        try:
+            self.reconnect_max = float(params("ReconnectMax"))
+        except NoOptionError:
+            self.reconnect_max = 120
+        # Failed attempts since the last connect, drives the backoff.
+        self.reconnect_attempts = 0
 
         self.msg_processor = msg_processor
 
+        self.spool = None
+        try:
+            spool_dir = params("SpoolDir")
+            try:
+                max_messages = int(params("SpoolMaxMessages"))
+            except NoOptionError:
+                max_messages = 10000
+            try:
+                replay = params("SpoolReplay")
+            except NoOptionError:
+                replay = "Ordered"
+            try:
+                rate = float(params("SpoolRate"))
+            except NoOptionError:
+                rate = 10.0
+            self.spool = MessageSpool(os.path.join(spool_dir,
+                                                   client_name + ".db"),
+                                      max_messages, replay, rate)
+        except NoOptionError:
+            pass
+
+        try:
+            self.v5 = params("Protocol") == "5"
+        except NoOptionError:
+            self.v5 = False
+        try:
+            self.topic_aliases = int(params("TopicAliases"))
+        except NoOptionError:
+            self.topic_aliases = 10
+        try:
+            self.message_expiry = int(params("MessageExpiry"))
+        except NoOptionError:
+            self.message_expiry = None
+        self.user_properties = []
+        try:
+            for pair in params("UserProperties").split(","):
+                name, value = pair.split(":", 1)
+                self.user_properties.append((name.strip(), value.strip()))
+        except NoOptionError:
+            pass
+        # Topic aliases are only valid for one network connection, they are
+        # reset by on_connect and on_disconnect.
+        self.alias_lock = Lock()
+        self.alias_max = 0
+        self.aliases = {}
+        self.publish_counts = {}
+
         # Initialize the client
-        self.client = mqtt.Client(client_id=client_name, clean_session=True)
+        if self.v5:
+            self.client = mqtt.Client(client_id=client_name,
+                                      protocol=mqtt.MQTTv5)
+        else:
+            self.client = mqtt.Client(client_id=client_name, clean_session=True)
         if tls in ("yes", "true", "1"):
             self.log.debug("TLS is true, CA cert is: {}".format(ca_cert))
             self.client.tls_set(ca_cert)
@@ -97,69 +266,119 @@ class MqttConnection(Connection):
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_subscribe = self.on_subscribe
+        self.client.on_message = self.on_message
         self.client.on_publish = self.on_publish
+        self.client.on_connect_fail = self.on_connect_fail
         self.client.username_pw_set(user, passwd)
+        try:
+            # QoS 1 and 2 publishes are pipelined up to this many at a time.
+            self.client.max_inflight_messages_set(int(params("MaxInflight")))
+        except NoOptionError:
+            pass
+        try:
+            max_queued = int(params("MaxQueued"))
+        except NoOptionError:
+            max_queued = 1000
+        # Bounds the memory used by the QoS 1 and 2 messages during an outage.
+        self.client.max_queued_messages_set(max_queued)
+        self._next_reconnect_delay()
 
-        self.log.info(
-            "Attempting to connect to MQTT broker at %s:%s", self.host, self.port
-        )
         self.connected = False
-        self._connect()
+        self.connects = 0
+        self.disconnects = 0
+        self.failed_attempts = 0
+        # QoS 1 and 2 messages dropped because paho's queue was full
+        self.queue_dropped = 0
+        self.disconnected_since = monotonic()
+
+        # Recent publishes of actuator states whose echo is ignored
+        self.filter = EchoFilter()
 
         lwtt = "{}/{}".format(self.root_topic, LWT)
         ref = "{}/{}".format(self.root_topic, REFRESH)
 
         self.log.info(
             "LWT topic is %s, subscribing to refresh topic %s", lwtt, ref)
+        # The will has to be set before connecting to be sent to the broker.
         self.client.will_set(lwtt, OFFLINE, qos=2, retain=True)
         self.register(REFRESH, msg_processor)
 
+        self.log.info(
+            "Attempting to connect to MQTT broker at %s:%s", self.host, self.port
+        )
+        self.client.connect_async(self.host, port=self.port,
+                                  keepalive=self.keepalive)
         self.client.loop_start()
-        self._publish_mqtt(ONLINE, LWT, True)
-
-        #init dictionary for publish actuator status
-        self.filter = {}
-
-    def _connect(self):
-        while not self.connected:
-            try:
-                self.client.connect(self.host, port=self.port,
-                                    keepalive=self.keepalive)
-                self.connected = True
-            except socket.error:
-                self.log.error("Error connecting to %s:%s",
-                               self.host, self.port)
-                self.log.debug("Exception: %s", traceback.format_exc())
-                sleep(5)
-                self.connected = False
-
-        self.log.info("Connection to MQTT is successful")
 
     def publish(self, message, destination, filter_echo=False):
-        """Publishes message to destination, logging if there is an error."""
+        """Publishes message to destination, logging if there is an error.
+        While disconnected QoS 0 messages are spooled or the newest one per
+        destination is held and published on reconnect. While the spool is
+        replayed QoS 0 messages are spooled behind it so they don't arrive
+        before older values. QoS 1 and 2 messages
+        are always passed to the MQTT client, which queues every one of them
+        until it is connected.
+        """
+        qos = self.dest_qos.get(destination, self.qos)
+        if not self.connected and not qos and self.spool:
+            self.log.debug("MQTT is not currently connected! Spooling message: "
+                           "%s, for topic: %s", message, destination)
+            self.spool.put(message, destination)
+            return
+        if (not self.connected and not qos
+                and self._hold(message, destination, filter_echo)):
+            self.log.debug("MQTT is not currently connected! Holding message: "
+                           "%s, for topic: %s", message, destination)
+            return
+        if not qos and self.spool and self.spool.put_behind(message,
+                                                             destination):
+            self.log.debug("Replaying the spool! Spooling message: %s, for "
+                           "topic: %s", message, destination)
+            return
+
         if filter_echo:
-            # remember full_topic, msg and timestamp for later filtering
-            # of looped back anwser of the mqtt server
-            full_topic = "{}/{}".format(self.root_topic, destination)
-            if full_topic not in self.filter:
-                self.filter[full_topic] = {}
-            self.filter[full_topic][message] = datetime.datetime.now()
+            # remember full_topic and msg for later filtering of looped back
+            # anwser of the mqtt server
+            self.filter.add("{}/{}".format(self.root_topic, destination),
+                            message)
 
         self._publish_mqtt(message, destination, False)
 
     def _publish_mqtt(self, message, topic, retain):
         try:
-            if not self.connected:
+            qos = self.dest_qos.get(topic, self.qos)
+            if not self.connected and not qos:
                 self.log.warning(
                     "MQTT is not currently connected!"
                     " Ignoring message: %s, for topic: %s" , message, topic)
                 return
             full_topic = "{}/{}".format(self.root_topic, topic)
-            rval = self.client.publish(
-                full_topic, message, retain=retain, qos=0)
-            if rval[0] == mqtt.MQTT_ERR_NO_CONN:
+            if self.v5:
+                # The publish that assigns an alias has to be sent before the
+                # ones using it.
+                with self.alias_lock:
+                    pub_topic, props = self._properties(full_topic, qos, retain)
+                    rval = self.client.publish(pub_topic, message,
+                                               retain=retain, qos=qos,
+                                               properties=props)
+            else:
+                rval = self.client.publish(
+                    full_topic, message, retain=retain, qos=qos)
+            if rval[0] == mqtt.MQTT_ERR_NO_CONN and qos:
+                # paho keeps QoS 1 and 2 messages and sends them on connect
+                self.log.debug("MQTT is not currently connected! Queued "
+                               "message %s to %s", message, full_topic)
+            elif rval[0] == mqtt.MQTT_ERR_QUEUE_SIZE:
+                self.queue_dropped += 1
+                self.log.warning("MQTT queue is full! Dropping message %s to "
+                                 "%s", message, full_topic)
+            elif rval[0] == mqtt.MQTT_ERR_NO_CONN:
                 self.log.error(
                     "Error puiblishing update %s to %s", message, full_topic)
+                if not retain and self.spool:
+                    self.spool.put(message, topic)
+                elif not retain:
+                    self._hold(message, topic)
             else:
                 self.log.debug(
                     "Published message %s to %s retain=%s", message, full_topic, retain
@@ -169,55 +388,139 @@ class MqttConnection(Connection):
                 "Unexpected error publishing MQTT message: %s", traceback.format_exc()
             )
 
+    def _properties(self, full_topic, qos, retain):
+        """Returns the topic to publish to and the MQTT 5 properties of a
+        message. A topic published to more than once gets a topic alias while
+        there are aliases left, after that only the alias is sent. Only QoS 0
+        messages use aliases as paho may resend the others on a new connection
+        where the alias is unknown. Must be called with alias_lock held.
+        """
+        props = Properties(PacketTypes.PUBLISH)
+        if self.user_properties:
+            props.UserProperty = self.user_properties
+        if self.message_expiry and not retain:
+            props.MessageExpiryInterval = self.message_expiry
+        if qos or retain or not self.alias_max:
+            return full_topic, props
+
+        alias = self.aliases.get(full_topic)
+        if alias:
+            props.TopicAlias = alias
+            return "", props
+        count = self.publish_counts.get(full_topic, 0) + 1
+        self.publish_counts[full_topic] = count
+        if count > 1 and len(self.aliases) < self.alias_max:
+            alias = len(self.aliases) + 1
+            self.aliases[full_topic] = alias
+            props.TopicAlias = alias
+        return full_topic, props
+
+    def _reset_aliases(self, broker_max=0):
+        """Forgets the topic aliases of the previous network connection and
+        sets how many may be used on the new one.
+        """
+        with self.alias_lock:
+            self.aliases = {}
+            self.alias_max = min(self.topic_aliases, broker_max)
+
     def disconnect(self):
         """Closes the connection to the MQTT broker."""
         self.log.info("Disconnecting from MQTT")
         self._publish_mqtt(OFFLINE, LWT, True)
         self.client.loop_stop()
         self.client.disconnect()
+        if self.spool:
+            self.spool.close()
+
+    def _covered(self, full_topic):
+        """Returns True if the SubscribeTopic subscription already delivers
+        the messages for the full_topic filter.
+        """
+        if not self.subscription:
+            return False
+        if "+" in full_topic or "#" in full_topic:
+            return (self.subscription.endswith("/#")
+                    and full_topic.startswith(self.subscription[:-1]))
+        return mqtt.topic_matches_sub(self.subscription, full_topic)
+
+    def _subscriptions(self):
+        """Returns the topic filters the client needs to be subscribed to."""
+        topics = [self.subscription] if self.subscription else []
+        topics.extend(topic for topic in self.registered
+                      if not self._covered(topic))
+        return topics
 
     def register(self, destination, handler):
         """Registers a handler to be called on messages received on topic
-        appended to the root_topic. Handler is expected to take one argument,
-        the message.
+        appended to the root_topic. The topic may contain the MQTT + and #
+        wild cards. Handler is expected to take one argument, the message.
         """
         full_topic = "{}/{}".format(self.root_topic, destination)
         self.log.info("Registering for messages on '%s'", full_topic)
-
-        def on_message(client, userdata, msg):
-            message = msg.payload.decode("utf-8")
-            # filter messages which have been send via publish_actuator_state,
-            # to ignore own actuator status updates
-            # if a filter entry for the recived topic and
-            # message exists check if it is not older than x seconds
-            handle_msg = True
-            if msg.topic in self.filter:
-                if message in self.filter[msg.topic]:
-                    time_send = self.filter[msg.topic][message]
-                    if (datetime.datetime.now() - time_send).total_seconds() < 1:
-                        handle_msg = False
-                    self.filter[msg.topic].pop(message, None)
-
-            if handle_msg:
-                self.log.debug(
-                "Received message client %s userdata %s and msg: %s",
-                client,
-                userdata,
-                message
-                )
-
+        # Several handlers, e.g. of different actuators, can share a topic.
+        handlers = self.registered.setdefault(full_topic, [])
+        handlers.append(handler)
+        self.handlers.add(full_topic, handler)
+        if len(handlers) == 1 and not self._covered(full_topic):
+            self.client.subscribe(full_topic, qos=self.qos)
+
+    def unregister(self, destination, handler=None):
+        """Removes handler, or all the handlers if None, from the topic
+        appended to the root_topic. Unsubscribes once the topic has no
+        handlers left.
+        """
+        full_topic = "{}/{}".format(self.root_topic, destination)
+        self.log.info("Unregistering for messages on '%s'", full_topic)
+        handlers = self.registered.get(full_topic)
+        if not handlers or not self.handlers.remove(full_topic, handler):
+            return
+        if handler is None:
+            handlers.clear()
+        else:
+            handlers.remove(handler)
+        if not handlers:
+            del self.registered[full_topic]
+            if not self._covered(full_topic):
+                self.client.unsubscribe(full_topic)
+
+    def on_message(self, client, userdata, msg):
+        """Called for every message received, passes it to the handlers
+        registered for a matching topic.
+        """
+        handlers = self.handlers.match(msg.topic)
+        if not handlers:
+            return
+        message = msg.payload.decode("utf-8")
+        # filter messages which have been send via publish_actuator_state,
+        # to ignore own actuator status updates
+        if self.filter.is_echo(msg.topic, message):
+            self.log.debug("Filtered msg (%s) for topic: %s", message, msg.topic)
+            return
+
+        self.log.debug("Received message client %s userdata %s and msg: %s",
+                       client, userdata, message)
+        for handler in handlers:
+            try:
                 handler(message)
-            else:
-                self.log.debug("Filtered msg (%s) for topic: %s", message, msg.topic)
-
-        self.registered[full_topic] = on_message
-        self.client.subscribe(full_topic, qos=0)
-        self.client.message_callback_add(full_topic, on_message)
+            except Exception:
+                self.log.error("Error handling message %s on %s: %s", message,
+                               msg.topic, traceback.format_exc())
 
-    def on_connect(self, client, userdata, flags, retcode):
+    def on_connect(self, client, userdata, flags, retcode, properties=None):
         """Called when the client connects to the broker, resubscribe to the
-        sensorReporter topic.
+        sensorReporter topic. properties are the CONNACK properties in MQTT 5.
+        A refused connection, e.g. bad credentials, counts as a failed attempt
+        and backs off, paho disconnects and tries again.
         """
+        if retcode != 0:
+            self.failed_attempts += 1
+            self.reconnect_attempts += 1
+            self._next_reconnect_delay()
+            self.log.error("Connection to %s:%s refused, code %s: %s, "
+                           "attempt %s", self.host, self.port, retcode,
+                           mqtt.connack_string(retcode), self.failed_attempts)
+            return
+
         refresh = "{}/{}".format(self.root_topic, REFRESH)
         self.log.info(
             "Connected with client %s, userdata %s, flags %s, and "
@@ -229,22 +532,61 @@ class MqttConnection(Connection):
             refresh,
         )
 
+        if self.v5:
+            # The broker tells how many aliases it accepts, none if not sent.
+            self._reset_aliases(getattr(properties, "TopicAliasMaximum", 0))
+
         self.connected = True
+        self.connects += 1
+        self.disconnected_since = None
+        self.reconnect_attempts = 0
+        self._next_reconnect_delay()
 
         # Publish the ONLINE message to the LWT
         self._publish_mqtt(ONLINE, LWT, True)
 
-        # Resubscribe on connection
-        for reg in self.registered:
-            self.log.info("on_connect: Resubscribing to %s", reg)
-            self.client.subscribe(reg)
+        # Resubscribe on connection, all topics in one SUBSCRIBE packet
+        topics = self._subscriptions()
+        if topics:
+            self.log.info("on_connect: Resubscribing to %s", topics)
+            self.client.subscribe([(topic, self.qos) for topic in topics])
+
+        # Publish what was held while disconnected
+        self._publish_held()
+        if self.spool:
+            self.spool.replay(lambda msg, dest: self._publish_mqtt(msg, dest,
+                                                                   False),
+                              lambda: self.connected)
 
         # causes sensors to republish their states
         self.msg_processor("MQTT connected")
 
-    def on_disconnect(self, client, userdata, retcode):
+    def get_metrics(self):
+        """Adds the connection status, reconnect counts and the number of
+        spooled messages to the Connection metrics.
+        """
+        metrics = super().get_metrics()
+        disconnected_since = self.disconnected_since
+        metrics["mqtt"] = {
+            "connected": self.connected,
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "failed_attempts": self.failed_attempts,
+            "queue_dropped": self.queue_dropped,
+            "pending_echoes": len(self.filter),
+            "topic_aliases": len(self.aliases),
+            "disconnected_for": 0 if disconnected_since is None
+                                else round(monotonic() - disconnected_since, 3)
+        }
+        if self.spool:
+            metrics["spooled"] = len(self.spool)
+            metrics["spool_dropped"] = self.spool.dropped
+        return metrics
+
+    def on_disconnect(self, client, userdata, retcode, properties=None):
         """Called when the client disconnects from the broker. If the reason was
-        not because disconnect() was called, try to reconnect.
+        not because disconnect() was called, the MQTT network thread reconnects
+        with backoff.
         """
         self.log.info(
             "Disconnected from MQTT broker with client %s, userdata " "%s, and code %s",
@@ -253,14 +595,42 @@ class MqttConnection(Connection):
             retcode,
         )
 
+        if self.connected:
+            # Not after a refused connection attempt
+            self.disconnects += 1
+            self.disconnected_since = monotonic()
         self.connected = False
+        self._reset_aliases()
+        self._next_reconnect_delay()
         if retcode != 0:
             self.log.error(
                 "Unexpected disconnect code %s: %s reconnecting",
                 retcode,
                 mqtt.error_string(retcode),
             )
-            self._connect()
+
+    def on_connect_fail(self, client, userdata):
+        """Called when a connection attempt fails, the MQTT network thread
+        tries again after the reconnect delay.
+        """
+        self.failed_attempts += 1
+        self.reconnect_attempts += 1
+        self._next_reconnect_delay()
+        self.log.error("Error connecting to %s:%s, attempt %s",
+                       self.host, self.port, self.failed_attempts)
+
+    def _next_reconnect_delay(self):
+        """Sets the delay before the next reconnect attempt: ReconnectMin
+        doubled for every failed attempt up to ReconnectMax, times a random
+        factor between 1 and 1.5 drawn anew for every attempt so the retries
+        of many nodes that lost the same broker stay spread out. Both bounds
+        are set to the delay so paho's own doubling doesn't apply, setting
+        them also restarts paho's backoff.
+        """
+        delay = min(self.reconnect_min * 2 ** min(self.reconnect_attempts, 16),
+                    self.reconnect_max)
+        delay = max(1, round(delay * random.uniform(1, 1.5)))
+        self.client.reconnect_delay_set(min_delay=delay, max_delay=delay)
 
     def on_publish(self, client, userdata, retcode):
         """Called when a message is published. """
@@ -271,7 +641,7 @@ class MqttConnection(Connection):
             retcode,
         )
 
-    def on_subscribe(self, client, userdata, retcode, qos):
+    def on_subscribe(self, client, userdata, retcode, qos, properties=None):
         """Called when a topic is subscribed to. """
         self.log.debug(
             "on_subscribe: Successfully subscribed %s, %s, %s, %s",
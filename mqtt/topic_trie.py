@@ -0,0 +1,99 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contains the topic trie the MqttConnection uses to find the handlers for
+an incoming message.
+
+Classes: TopicTrie
+"""
+from threading import Lock
+
+class _Node:
+    """One topic level, its child levels and the handlers of the topic filters
+    ending at this level.
+    """
+    __slots__ = ("children", "handlers")
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+class TopicTrie:
+    """Maps MQTT topic filters, including the + and # wild cards, to handlers.
+    Finding the handlers for a topic takes one step per topic level no matter
+    how many filters are registered.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.lock = Lock()
+
+    def add(self, topic_filter, handler):
+        """Adds handler to be returned for the topics matching topic_filter."""
+        with self.lock:
+            node = self.root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, _Node())
+            node.handlers.append(handler)
+
+    def remove(self, topic_filter, handler=None):
+        """Removes handler from topic_filter, or all the handlers of
+        topic_filter if handler is None. Returns True if any were removed.
+        """
+        with self.lock:
+            path = [self.root]
+            levels = topic_filter.split("/")
+            for level in levels:
+                node = path[-1].children.get(level)
+                if node is None:
+                    return False
+                path.append(node)
+            node = path[-1]
+            if handler is None:
+                found = bool(node.handlers)
+                node.handlers = []
+            else:
+                found = handler in node.handlers
+                if found:
+                    node.handlers.remove(handler)
+            # Prune the levels that no longer lead to any handler.
+            for idx in range(len(levels), 0, -1):
+                if path[idx].handlers or path[idx].children:
+                    break
+                del path[idx - 1].children[levels[idx - 1]]
+            return found
+
+    def match(self, topic):
+        """Returns the handlers of all the filters that match topic."""
+        handlers = []
+        with self.lock:
+            self._match(self.root, topic.split("/"), 0, handlers)
+        return handlers
+
+    def _match(self, node, levels, idx, handlers):
+        """Collects the handlers under node matching levels[idx:]."""
+        multi = node.children.get("#")
+        if multi:
+            # "a/#" also matches "a"
+            handlers.extend(multi.handlers)
+        if idx == len(levels):
+            handlers.extend(node.handlers)
+            return
+        for key in (levels[idx], "+"):
+            child = node.children.get(key)
+            if child:
+                self._match(child, levels, idx + 1, handlers)
+
+    def __bool__(self):
+        return bool(self.root.children)
@@ -16,27 +16,60 @@
 Classes:
     - openhab_rest: publishes state updates to openHAB Items.
 """
-from threading import Thread, Timer
+from concurrent.futures import wait
+from threading import Thread, Event, Lock
 from configparser import NoOptionError
+from distutils.util import strtobool
+from time import monotonic
 import json
+import random
+import socket
 import traceback
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sseclient
 from core.connection import Connection
+from core.worker_pool import WorkerPool
 
-def connect_oh_rest(caller):
-    """ Subscribe to SSE events and start processing the events
-        if API-Token is provided and supported then include it in the request"""
-    try:
-        if caller.openhab_version >= 3.0 and bool(caller.api_token):
-            header = {'Authorization': 'Bearer ' + caller.api_token }
-            stream = requests.get("{}/rest/events".format(caller.openhab_url),
-                                  headers=header, stream=True)
+# Seconds to wait for an SSE event after a successful Item update before the
+# SSE subscription is considered dead.
+WATCHDOG_TIMEOUT = 2
+
+# Seconds the SSE topic filter must stay unchanged before subscribing with it,
+# so the registrations and first Item updates at startup or after a reload
+# share one subscription instead of resubscribing for each of them.
+TOPICS_SETTLE = 2
 
-        else:
-            stream = requests.get("{}/rest/events".format(caller.openhab_url),
-                                  stream=True)
-        caller.client = sseclient.SSEClient(stream)
+# Maximum seconds the first subscription waits for the topic filter to settle.
+TOPICS_SETTLE_MAX = 10
+
+# Outbound queue settings used in bulk mode unless configured otherwise.
+BULK_DEFAULTS = {
+    "QueueSize": "1000",
+    "QueuePolicy": "Coalesce",
+    "QueueBatch": "50",
+    "QueueWindow": "0.05"
+}
+
+def connect_oh_rest(caller, last_event_id=None):
+    """ Subscribe to SSE events and return the streaming response, None on an
+        error.
+        if API-Token is provided and supported then include it in the request.
+        Passes last_event_id on so a server that supports it can resume."""
+    # Let openHAB only send the events the reciever needs.
+    query = {"topics": caller.event_topics} if caller.event_topics else None
+    header = {'Accept': 'text/event-stream'}
+    if caller.openhab_version >= 3.0 and bool(caller.api_token):
+        header['Authorization'] = 'Bearer ' + caller.api_token
+    if last_event_id:
+        header['Last-Event-ID'] = last_event_id
+    try:
+        stream = requests.get("{}/rest/events".format(caller.openhab_url),
+                              params=query, headers=header, stream=True,
+                              timeout=(10, caller.read_timeout))
+        stream.raise_for_status()
+        return stream
 
     except requests.exceptions.Timeout:
         caller.log.error("Timed out connecting to %s", caller.openhab_url)
@@ -44,8 +77,7 @@ def connect_oh_rest(caller):
         caller.log.error("Failed to connect to %s, response: %s", caller.openhab_url, ex)
     except requests.exceptions.HTTPError as ex:
         caller.log.error("Received and unsuccessful response code %s", ex)
-
-    caller.reciever = OpenhabReciever(caller)
+    return None
 
 class OpenhabREST(Connection):
     """Publishes a state to a given openHAB Item. Expects there to be a URL
@@ -61,13 +93,44 @@ class OpenhabREST(Connection):
         command will cause sensor_reporter to publish the most recent states of
         all the sensors.
         - msg_processor: message handler for command to the RefreshItem
+        - "PoolSize": optional number of kept alive HTTP connections used for
+        the Item updates, default is 4.
+        - "Retries": optional number of times a failed Item update is retried,
+        default is 2.
+        - "Timeout": optional seconds to wait for openHAB to answer an Item
+        update, default is 10.
+        - "ReadTimeout": optional seconds without any SSE event after which
+        the subscription is reconnected. Defaults to 60 for openHAB 3, which
+        sends an ALIVE event every few seconds, and no timeout for openHAB 2.
+        - "ReconnectMin": optional seconds before reconnecting a lost SSE
+        subscription, doubled after every failed attempt, default is 1.
+        - "ReconnectMax": optional cap on the seconds between reconnect
+        attempts, default is 60.
+        - "TopicFilter": optional, defaults to True, subscribe only to the
+        command events of the registered Items and the state events of the
+        updated Items instead of all the events on the bus.
+        - "Bulk": optional, when True the Item updates are queued, updates to
+        the same Item coalesced and the queued ones sent PoolSize at a time.
+        Uses the BULK_DEFAULTS for the Queue parameters not configured.
         """
-        super().__init__(msg_processor, params)
+        try:
+            bulk = bool(strtobool(params("Bulk")))
+        except NoOptionError:
+            bulk = False
+
+        def bulk_params(key):
+            try:
+                return params(key)
+            except NoOptionError:
+                if key in BULK_DEFAULTS:
+                    return BULK_DEFAULTS[key]
+                raise
+
+        super().__init__(msg_processor, bulk_params if bulk else params)
         self.log.info("Initializing openHAB REST Connection...")
 
         self.openhab_url = params("URL")
         self.refresh_item = params("RefreshItem")
-        self.registered[self.refresh_item] = msg_processor
 
         # optional OpenHAB Verison and optional API-Token for connections with authentication
         try:
@@ -85,10 +148,99 @@ class OpenhabREST(Connection):
                 self.log.info("No API-Token specified,"
                 " connecting to openHAB without authentication")
 
-        self.client = None
-        self.reciever = None
-        connect_oh_rest(self)
+        # openHAB 2.x locates the items on a different topic
+        self.topic_prefix = "{}/items/".format(
+            "smarthome" if self.openhab_version < 3.0 else "openhab")
+        try:
+            self.topic_filter = bool(strtobool(params("TopicFilter")))
+        except NoOptionError:
+            self.topic_filter = True
+        # Maps the command event topic of each registered Item to the Item
+        self.command_topics = {}
+        # The Items updated so far, the watchdog waits for their state events.
+        self.published = set()
+        self.topics_lock = Lock()
+        self.event_topics = None
+        # Monotonic time event_topics last changed.
+        self.topics_changed = monotonic()
+        self.register(self.refresh_item, msg_processor)
+        try:
+            self.read_timeout = float(params("ReadTimeout"))
+        except NoOptionError:
+            self.read_timeout = 60 if self.openhab_version >= 3.0 else None
+        try:
+            self.reconnect_min = float(params("ReconnectMin"))
+        except NoOptionError:
+            self.reconnect_min = 1
+        try:
+            self.reconnect_max = float(params("ReconnectMax"))
+        except NoOptionError:
+            self.reconnect_max = 60
+        try:
+            pool_size = int(params("PoolSize"))
+        except NoOptionError:
+            pool_size = 4
+        try:
+            retries = int(params("Retries"))
+        except NoOptionError:
+            retries = 2
+        try:
+            self.timeout = float(params("Timeout"))
+        except NoOptionError:
+            self.timeout = 10
+
+        # One session for all the Item updates keeps the connections to
+        # openHAB alive and the headers built once.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries,
+                                                backoff_factor=0.2,
+                                                status_forcelist=(502, 503,
+                                                                  504)))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Sends the Item updates of a batch concurrently in bulk mode.
+        self.workers = WorkerPool(pool_size, "openhab-put") if bulk else None
+        # openHAB 2.x doesn't need the Content-Type header
+        if self.openhab_version >= 3.0:
+            self.session.headers['Content-Type'] = 'text/plain'
+            if bool(self.api_token):
+                self.session.headers['Authorization'] = ("Bearer "
+                                                         + self.api_token)
+
+        # Monotonic times of the last SSE event received and of the start of
+        # the last successful Item update, watched by the _monitor thread.
+        self.last_event = monotonic()
+        self.last_put = None
+        self.stop_monitor = Event()
+        self.reciever = OpenhabReciever(self)
+        self.monitor = Thread(target=self._monitor, name="openhab-watchdog",
+                              daemon=True)
+        self.monitor.start()
 
+    def _monitor(self):
+        """Reconnects the SSE subscription when openHAB accepted an Item update
+        but no event, e.g. the resulting state update, arrived within
+        WATCHDOG_TIMEOUT seconds, e.g. after openHAB restarted. Also
+        resubscribes once the event_topics changed and then stayed the same for
+        TOPICS_SETTLE seconds.
+        """
+        while not self.stop_monitor.wait(1):
+            if (self.reciever.connected
+                    and self.reciever.topics != self.event_topics
+                    and self.topics_settled()):
+                self.log.info("Event topics changed, resubscribing")
+                # The state event of an update made before the resubscription
+                # may never arrive.
+                self.last_put = None
+                self.reciever.resubscribe()
+                continue
+            put = self.last_put
+            if (put is not None and self.last_event < put
+                    and monotonic() - put > WATCHDOG_TIMEOUT):
+                self.log.info("connection EXPIRED, reconnecting")
+                self.last_put = None
+                self.reciever.reconnect()
 
 
     def publish(self, message, destination, filter_echo=False):
@@ -96,26 +248,22 @@ class OpenhabREST(Connection):
 
         Handle filter_echo=True the same way as usual publishing of messages
         since openHAB won't send an status update to all subcribers"""
-        self.reciever.start_watchdog()
+        if self.topic_filter and destination not in self.published:
+            with self.topics_lock:
+                self.published.add(destination)
+                self._update_event_topics()
+        sent = monotonic()
         try:
             self.log.debug("Publishing message %s to %s", message, destination)
-            # openHAB 2.x doesn't need the Content-Type header
-            if self.openhab_version < 3.0:
-                response = requests.put("{}/rest/items/{}/state"
-                                    .format(self.openhab_url, destination),
-                                    data=message, timeout=10)
-            else:
-                # define header for OH3 communication and authentication
-                header = {'Content-Type': 'text/plain'}
-                if bool(self.api_token):
-                    header['Authorization'] = "Bearer " + self.api_token
-
-                response = requests.put("{}/rest/items/{}/state"
-                                    .format(self.openhab_url, destination),
-                                    headers=header, data=message, timeout=10)
+            response = self.session.put("{}/rest/items/{}/state"
+                                        .format(self.openhab_url, destination),
+                                        data=message, timeout=self.timeout)
 
             response.raise_for_status()
-            self.reciever.activate_watchdog()
+            # The SSE event for this update may arrive before the response
+            # so the watchdog compares with the time the update was sent.
+            if self._watched(destination):
+                self.last_put = max(sent, self.last_put or sent)
         except ConnectionError:
             self.log.error("Failed to connect to %s\n%s", self.openhab_url,
                            traceback.format_exc())
@@ -127,27 +275,160 @@ class OpenhabREST(Connection):
             self.log.error("Failed to connect to %s, response: %s", self.openhab_url, ex)
         except requests.exceptions.HTTPError as ex:
             self.log.error("Received and unsuccessful response code %s", ex)
+        except requests.exceptions.RetryError as ex:
+            self.log.error("Giving up on update of %s: %s", destination, ex)
+
+    def get_metrics(self):
+        """Adds the health of the SSE subscription to the Connection metrics."""
+        metrics = super().get_metrics()
+        metrics["sse"] = self.reciever.get_metrics()
+        return metrics
+
+    def register(self, destination, handler):
+        """Registers handler for the commands to the Item destination."""
+        super().register(destination, handler)
+        with self.topics_lock:
+            topic = "{}{}/command".format(self.topic_prefix, destination)
+            self.command_topics[topic] = destination
+            self._update_event_topics()
+
+    def unregister(self, destination, handler=None):
+        """Stops passing the commands to the Item destination on."""
+        super().unregister(destination, handler)
+        if destination not in self.registered:
+            with self.topics_lock:
+                self.command_topics.pop("{}{}/command".format(
+                    self.topic_prefix, destination), None)
+                self._update_event_topics()
+
+    def topics_settled(self):
+        """Returns True if event_topics didn't change for TOPICS_SETTLE
+        seconds.
+        """
+        return monotonic() - self.topics_changed >= TOPICS_SETTLE
+
+    def _watched(self, destination):
+        """Returns True if the current subscription receives the state events
+        of the Item destination, only then the watchdog can expect one.
+        """
+        return (not self.topic_filter
+                or "{}{}/state".format(self.topic_prefix, destination)
+                in self.reciever.topic_set)
+
+    def _update_event_topics(self):
+        """Rebuilds the SSE topic filter from the command topics of the
+        registered Items and the state topics of the updated Items, which the
+        watchdog needs. The _monitor thread resubscribes when it changed.
+        Must be called with topics_lock held.
+        """
+        if not self.topic_filter:
+            return
+        topics = sorted(self.command_topics)
+        topics.extend("{}{}/state".format(self.topic_prefix, item)
+                      for item in sorted(self.published))
+        event_topics = ",".join(topics)
+        if event_topics != self.event_topics:
+            self.event_topics = event_topics
+            self.topics_changed = monotonic()
+
+    def publish_batch(self, messages):
+        """In bulk mode sends the Item updates in messages concurrently over
+        the session's pooled connections and waits for all of them.
+        """
+        if not self.workers:
+            super().publish_batch(messages)
+            return
+        wait([self.workers.submit(self.publish, message, destination,
+                                  filter_echo)
+              for message, destination, filter_echo in messages])
 
     def disconnect(self):
         """Stops the event processing loop."""
         self.log.info("Disconnecting from openHAB SSE")
+        self.stop_monitor.set()
         self.reciever.stop()
+        if self.workers:
+            self.workers.shutdown(timeout=self.timeout)
+        self.session.close()
 
 class OpenhabReciever():
-    """Initiates a separate Task for recieving OH SSE.
+    """Initiates a separate Task for recieving OH SSE. The task keeps the
+    subscription alive: when it fails or the stream ends it reconnects after a
+    backoff that doubles from ReconnectMin to ReconnectMax.
     """
 
     def __init__(self, caller):
-        self.stop_thread = False
-        # copy reciever object to local class
-        self.client = caller.client
+        self.stop_event = Event()
+        self.stream = None
+        self.client = None
         self.caller = caller
-        self.watchdog = None
-        self.watchdog_activ = False
-        # in case of a connection error dont start the get_messages thread
-        if self.client:
-            self.thread = Thread(target=self._get_messages, args=(caller,))
-            self.thread.start()
+        self.last_event_id = None
+        # The event_topics of the current subscription and the set of them.
+        self.topics = None
+        self.topic_set = frozenset()
+        # Set by resubscribe() so closing the subscription isn't a failure.
+        self.resubscribing = False
+        self.connected = False
+        self.connects = 0
+        self.failures = 0
+        self.last_error = None
+        self.thread = Thread(target=self._supervise, name="openhab-sse",
+                             daemon=True)
+        self.thread.start()
+
+    def _supervise(self):
+        """Connects, processes the events until the subscription is lost and
+        reconnects until stop is called.
+        """
+        delay = self.caller.reconnect_min
+        # Let the Items registered and updated at startup go into the first
+        # subscription.
+        deadline = monotonic() + TOPICS_SETTLE_MAX
+        while (self.caller.topic_filter and not self.caller.topics_settled()
+               and monotonic() < deadline):
+            if self.stop_event.wait(0.2):
+                return
+        while not self.stop_event.is_set():
+            self.topics = self.caller.event_topics
+            self.topic_set = frozenset((self.topics or "").split(","))
+            self.stream = connect_oh_rest(self.caller, self.last_event_id)
+            if self.stream:
+                self.client = sseclient.SSEClient(self.stream)
+                self.caller.log.info("Subscribed to the openHAB SSE feed")
+                self.connected = True
+                self.connects += 1
+                delay = self.caller.reconnect_min
+                try:
+                    self._get_messages(self.caller)
+                    self.last_error = "Event stream ended"
+                except Exception as ex:
+                    self.last_error = str(ex)
+                    if not self.stop_event.is_set():
+                        self.caller.log.debug("SSE error: %s",
+                                              traceback.format_exc())
+                finally:
+                    # Only this thread closes the response, closing it while
+                    # it is being read blocks until the next event arrives.
+                    self.connected = False
+                    self.client.close()
+            else:
+                self.last_error = "Failed to connect"
+            if self.stop_event.is_set():
+                self.caller.log.debug("Old OpenHab connection closed")
+                return
+            if self.resubscribing:
+                self.resubscribing = False
+                continue
+
+            self.failures += 1
+            # Jitter so many nodes don't reconnect to a restarted openHAB at
+            # the same moment.
+            wait = random.uniform(delay / 2, delay)
+            self.caller.log.error("Lost the openHAB SSE feed (%s), "
+                                  "reconnecting in %.1f seconds",
+                                  self.last_error, wait)
+            self.stop_event.wait(wait)
+            delay = min(delay * 2, self.caller.reconnect_max)
 
     def _get_messages(self, caller):
         """Blocks until stop is set to True. Loops through all the events on the
@@ -155,57 +436,65 @@ class OpenhabReciever():
         Item's handler.
         """
         for event in self.client.events():
-            # reset reconnect watchdog
-            if self.watchdog:
-                self.watchdog.cancel()
+            # any event shows the subscription is alive
+            caller.last_event = monotonic()
 
-            if self.stop_thread:
-                self.client.close()
-                caller.log.debug("Old OpenHab connection closed")
+            if self.stop_event.is_set():
                 return
+            if event.id:
+                self.last_event_id = event.id
 
-            # See if this is an event we care about. Commands on registered Items.
+            # See if this is an event we care about. Commands on registered
+            # Items. Skip the rest without decoding them.
+            if "ItemCommandEvent" not in event.data:
+                continue
             decoded = json.loads(event.data)
-            if decoded["type"] == "ItemCommandEvent":
-                # openHAB 2.x locates the items on a different url
-                if caller.openhab_version < 3.0:
-                    item = decoded["topic"].replace("smarthome/items/",
-                                                    "").replace("/command", "")
-                else:
-                    item = decoded["topic"].replace("openhab/items/",
-                                                    "").replace("/command", "")
-                if item in caller.registered:
-                    payload = json.loads(decoded["payload"])
-                    msg = payload["value"]
-                    caller.log.info("Received command from %s: %s", item, msg)
-                    caller.registered[item](msg)
-
-    def _wd_timeout(self):
-        """watchdog handler: will reconnect to openhab when invoced"""
-        if self.watchdog_activ:
-            self.caller.log.info("connection EXPIRED, reconnecting")
-            self.stop()
-            connect_oh_rest(self.caller)
-
-    def start_watchdog(self):
-        """start watchdog before msg gets sent to openhabREST
-        if the watchdog gets activated and after 2s no msg from openHAB was
-        received the connection gets reseted
+            if decoded["type"] != "ItemCommandEvent":
+                continue
+            item = caller.command_topics.get(decoded["topic"])
+            handler = caller.registered.get(item) if item else None
+            if handler:
+                payload = json.loads(decoded["payload"])
+                msg = payload["value"]
+                caller.log.info("Received command from %s: %s", item, msg)
+                handler(msg)
+
+    def reconnect(self):
+        """Shuts down the socket of the current subscription, which ends the
+        blocked read in the task right away, the task then closes the response
+        and reconnects.
         """
-        if self.watchdog:
-            self.watchdog.cancel()
-        self.watchdog_activ = False
-        self.watchdog = Timer(2, self._wd_timeout)
-        self.watchdog.start()
-
-    def activate_watchdog(self):
-        """enable watchdog after msg was succesful send (no exeption due to connection error)
-        avoids a reconnect atempt when the connection was unsuccessful
+        stream = self.stream
+        try:
+            sock = stream.raw._fp.fp.raw._sock
+        except AttributeError:
+            # Not connected or the response is already closed.
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def resubscribe(self):
+        """Ends the current subscription, the task then subscribes again
+        right away with the latest event_topics.
         """
-        self.watchdog_activ = True
+        self.resubscribing = True
+        self.reconnect()
+
+    def get_metrics(self):
+        """Returns the health of the SSE subscription."""
+        return {
+            "connected": self.connected,
+            "connects": self.connects,
+            "failures": self.failures,
+            "last_event_age": round(monotonic() - self.caller.last_event, 3),
+            "last_error": self.last_error
+        }
 
     def stop(self):
-        """Sets a flag to stop the _get_messages thread and to close the openHAB connection.
-        Since the thread itself blocks until a message is recieved we won't wait for it
+        """Sets a flag to stop the task and ends the openHAB subscription, the
+        task closes it. We won't wait for the task, it's a daemon.
         """
-        self.stop_thread = True
+        self.stop_event.set()
+        self.reconnect()
@@ -15,16 +15,23 @@
 """The main script responsible for loading and parsing the .ini file, creating
 the polling manager and all of the connections, sensors, and actuators via
 reflection, and handling OS signals. On SIGINT it will exit. On SIGHUP it will
-stop and reload the config file to contine processing again.
+reload the config file and recreate only the sections that changed.
 
 Functions:
-    - reload_configuration: Called on SIGHUP, reloads the configuration
+    - reload_configuration: Called on SIGHUP, requests a reload of the
+    configuration
+    - reload_loop: Runs in the reload thread and reloads the configuration
+    when requested
+    - restart_poll_manager: Stops the polling manager and recreates everything
+    - apply_changes: Recreates the changed sections on the running polling
+    manager
     - terminate_process: Called on SIGINT and SIGTERM, cleans up and exits the
     program
     - init_logger: Initializes the logger based on the config in the .ini
     - create_connection: Creates a Connection based on the config in the .ini
     - create_device: Creates a Sensor or Actuator based on the config in the .ini
-    - create_poll_manager: Parses the .ini file and creates the logger,
+    - load_config: Reads and parses the .ini file
+    - create_poll_manager: Creates the logger,
     connections, sensors, and actuators and polling manager based on the config
     in the .ini.
     - on_message: called when a connection receives a message on the
@@ -36,7 +43,9 @@ Functions:
 """
 import signal
 import sys
+import time
 import traceback
+from threading import Event, Thread
 from configparser import ConfigParser, NoOptionError
 import logging
 import logging.handlers
@@ -46,41 +55,167 @@ from core.utils import set_log_level
 
 logger = logging.getLogger("sensor_reporter")
 poll_mgr = None
-
-def reload_configuration(signum, frame, config_file):
-    """Called when a SIGHUP is received. Stops the polling manager and recreates
-    it with the latest config file. Reregisters the signal handlers.
+# The ConfigParser the current poll_mgr was created from.
+active_config = None
+# Set on SIGHUP. Any number of SIGHUPs received while a reload is running
+# result in one more reload.
+reload_requested = Event()
+# Set by the reload thread when it replaced poll_mgr, main starts the new one.
+restarted = Event()
+
+def reload_configuration(signum, frame):
+    """Called when a SIGHUP is received. Only requests the reload, which is
+    done by the reload thread so the polling loop running in the main thread
+    isn't held up and reloads never nest.
     """
     logger.info('(SIGHUP) reading configuration: {} {}'.format(signum, frame))
+    reload_requested.set()
+
+def reload_loop(config_file):
+    """Run in the reload thread. Waits for a reload request, then compares the
+    latest config file to the running one section by section and only
+    recreates the Connections, Sensors and Actuators that changed. When the
+    PollManager section changed the polling manager is stopped and everything
+    is recreated.
+    """
+    while True:
+        reload_requested.wait()
+        reload_requested.clear()
+
+        if not poll_mgr:
+            logger.info("poll_mgr is not set! {}".format(poll_mgr))
+            continue
 
+        try:
+            config = load_config(config_file)
+            if section_items(config, "PollManager") != section_items(
+                    active_config, "PollManager"):
+                logger.info("PollManager section changed, recreating "
+                            "everything")
+                restart_poll_manager(config)
+            else:
+                apply_changes(config)
+        except:
+            logger.error("Error reloading the configuration: {}"
+                         .format(traceback.format_exc()))
+
+def restart_poll_manager(config):
+    """Stops the polling manager, which returns main from start(), and
+    recreates it from config for main to start. If that fails it is recreated
+    from the previous configuration. If that fails too poll_mgr is left None
+    and main exits.
+    """
     global poll_mgr
-    if poll_mgr:
-        poll_mgr.stop()
-        #cleanup poll_mgr compleatly befor starting over
-        poll_mgr = None
-        poll_mgr = create_poll_manager(config_file)
-        register_sig_handlers(config_file, poll_mgr)
-        poll_mgr.start()
-    else:
-        logger.info("poll_mgr is not set! {}".format(poll_mgr))
+    old_config = active_config
+    poll_mgr.stop()
+    #cleanup poll_mgr compleatly befor starting over
+    poll_mgr = None
+    try:
+        poll_mgr = create_poll_manager(config)
+    except:
+        logger.error("Error recreating the polling manager, restoring the "
+                     "previous configuration: {}"
+                     .format(traceback.format_exc()))
+        try:
+            poll_mgr = create_poll_manager(old_config)
+        except:
+            logger.critical("Error restoring the polling manager: {}"
+                            .format(traceback.format_exc()))
+    finally:
+        restarted.set()
+
+def section_items(config, section):
+    """Returns the raw values of section, including the DEFAULT section, as a
+    dict. Empty if the section doesn't exist.
+    """
+    if not config.has_section(section):
+        return {}
+    return dict(config.items(section, raw=True))
+
+def apply_changes(config):
+    """Recreates the sections of config that differ from active_config on the
+    running poll_mgr. Removed and changed objects are retired first so their
+    resources (e.g. GPIO pins) are released before the new ones are created.
+    Sensors and Actuators that use a recreated Connection are recreated too.
+    Everything else keeps running untouched.
+    """
+    global active_config
+    start = time.monotonic()
+    old = active_config
+
+    if section_items(config, "Logging") != section_items(old, "Logging"):
+        init_logger(config)
+
+    changed = {s for s in set(old.sections()) | set(config.sections())
+               if section_items(old, s) != section_items(config, s)}
+
+    def sections(cfg, prefix):
+        return [s for s in cfg.sections() if s.startswith(prefix)]
+
+    # Names of the connections that are removed or recreated.
+    replaced = {old.get(s, "Name") for s in sections(old, "Connection")
+                if s in changed}
+    replaced.update(config.get(s, "Name") for s in sections(config, "Connection")
+                    if s in changed)
+
+    def device_changed(section):
+        if section in changed:
+            return True
+        try:
+            conns = config.get(section, "Connection").split(",")
+        except NoOptionError:
+            conns = []
+        return any(c in replaced for c in conns)
+
+    stale_actuators = [s for s in sections(old, "Actuator")
+                       if s not in config or device_changed(s)]
+    stale_sensors = [s for s in sections(old, "Sensor")
+                     if s not in config or device_changed(s)]
+    logger.info("Reloading %d connections, %d actuators and %d sensors",
+                len(replaced), len(stale_actuators), len(stale_sensors))
+    poll_mgr.retire(stale_sensors, stale_actuators, replaced)
+
+    connections = {}
+    for section in [s for s in sections(config, "Connection") if s in changed]:
+        conn = create_connection(config, section)
+        if conn:
+            connections[config.get(section, "Name")] = conn
+    all_conns = dict(poll_mgr.connections, **connections)
+
+    actuators = {}
+    for section in [s for s in sections(config, "Actuator")
+                    if s not in old or device_changed(s)]:
+        actuator = create_device(config, section, all_conns)
+        if actuator:
+            actuators[section] = actuator
+
+    sensors = {}
+    for section in [s for s in sections(config, "Sensor")
+                    if s not in old or device_changed(s)]:
+        sensor = create_device(config, section, all_conns)
+        if sensor:
+            sensors[section] = sensor
+
+    poll_mgr.add(connections, sensors, actuators)
+    active_config = config
+    logger.info("Reload done in %.3f seconds", time.monotonic() - start)
 
-def terminate_process(signum, frame, poll_mgr):
-    """Called when a SIGTERM or SIGINT is received, exits the program."""
+def terminate_process(signum, frame):
+    """Called when a SIGTERM or SIGINT is received, exits the program. The
+    PollManager waits at most its ShutdownTimeout for the sensors.
+    """
     logger.info('(SIGTERM/SIGINT) terminating the process: {} {}'.format(signum, frame))
-    # TODO figure out how to set a timeout to wait for everything to exit
-    poll_mgr.stop()
+    if poll_mgr:
+        poll_mgr.stop()
     sys.exit()
 
-def register_sig_handlers(config_file, poll_mgr):
-    """Registers the singal handler functions with the passed in config_file
-    and poll_mgr.
+def register_sig_handlers():
+    """Registers the singal handler functions. They act on the current
+    poll_mgr so they don't need to be reregistered when it is recreated.
     """
-    signal.signal(signal.SIGHUP,
-                  lambda s, f: reload_configuration(s, f, config_file))
-    signal.signal(signal.SIGTERM,
-                  lambda s, f: terminate_process(s, f, poll_mgr))
-    signal.signal(signal.SIGINT,
-                  lambda s, f: terminate_process(s, f, poll_mgr))
+    signal.signal(signal.SIGHUP, reload_configuration)
+    signal.signal(signal.SIGTERM, terminate_process)
+    signal.signal(signal.SIGINT, terminate_process)
 
 def init_logger(config):
     """Initializes the logger based on the properties in the .ini file's Logging
@@ -176,13 +311,23 @@ def create_device(config, section, connections):
                      .format(section, traceback.format_exc()))
         return None
 
-def create_poll_manager(config_file):
-    """Loads and parses the config_file and based on it's contents initializes
-    the logger, creates the Connections, Sensors, and Actuators, and creates
-    the PollMgr to handle them all.
+def load_config(config_file):
+    """Reads and parses config_file. An empty PollManager section is added if
+    there is none.
     """
     config = ConfigParser(allow_no_value=True)
     config.read(config_file)
+    if not config.has_section("PollManager"):
+        config.add_section("PollManager")
+    return config
+
+def create_poll_manager(config):
+    """Based on the contents of the parsed config initializes the logger,
+    creates the Connections, Sensors, and Actuators, and creates the PollMgr
+    to handle them all.
+    """
+    global active_config
+    active_config = config
 
     init_logger(config)
 
@@ -197,11 +342,11 @@ def create_poll_manager(config_file):
     logger.debug("%d connections created", len(connections))
 
     # Create the Actuators
-    actuators = []
+    actuators = {}
     for section in [s for s in config.sections() if s.startswith("Actuator")]:
         actuator = create_device(config, section, connections)
         if actuator:
-            actuators.append(actuator)
+            actuators[section] = actuator
 
     logger.debug("%d actuators created", len(actuators))
 
@@ -215,7 +360,16 @@ def create_poll_manager(config_file):
     logger.debug("%d sensors created", len(sensors))
 
     logger.debug("Creating polling manager")
-    poll_mgr = PollManager(connections, sensors, actuators)
+    params = lambda key: config.get("PollManager", key)
+    try:
+        poll_mgr = PollManager(connections, sensors, actuators, params)
+    except:
+        # Release what was created, e.g. GPIO pins, before passing it on.
+        for device in list(sensors.values()) + list(actuators.values()):
+            device.cleanup()
+        for conn in connections.values():
+            conn.disconnect()
+        raise
     logger.debug("Created, returning polling manager")
     return poll_mgr
 
@@ -245,13 +399,21 @@ def main():
 
     config_file = sys.argv[1]
     global poll_mgr
-    poll_mgr = create_poll_manager(config_file)
+    poll_mgr = create_poll_manager(load_config(config_file))
 
     # Register functions to handle signals
-    register_sig_handlers(config_file, poll_mgr)
+    register_sig_handlers()
+    Thread(target=reload_loop, args=(config_file,), name="reload",
+           daemon=True).start()
 
-    # Starting polling loop
-    poll_mgr.start()
+    # Starting polling loop, start() returns when a reload recreated poll_mgr
+    while True:
+        poll_mgr.start()
+        restarted.wait()
+        restarted.clear()
+        if not poll_mgr:
+            logger.critical("No polling manager, exiting")
+            sys.exit(1)
 
 if __name__ == '__main__':
     main()